@@ -0,0 +1,5 @@
+# Makes bulky's modules importable from the tests
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "bulky"))
@@ -0,0 +1,20 @@
+# Helpers to check rename schedules without touching the disk
+
+def temp_names():
+    # Predictable temporary names for scheduler.schedule()
+    count = [0]
+    def temp_name():
+        count[0] += 1
+        return ".tmp%d" % count[0]
+    return temp_name
+
+def rename_paths(paths, steps):
+    # Carry out (old uri, new uri) steps on a set of uris, renamed
+    # directories move their contents
+    paths = set(paths)
+    for old_uri, new_uri in steps:
+        for path in list(paths):
+            if path == old_uri or path.startswith(old_uri + "/"):
+                paths.remove(path)
+                paths.add(new_uri + path[len(old_uri):])
+    return paths
@@ -0,0 +1,114 @@
+import datetime
+import unittest
+
+import engine
+from engine import RenameParams, RenamePipeline, RenamePlan
+
+class TemplateTest(unittest.TestCase):
+    def test_constant(self):
+        template = engine.Template("photo")
+        self.assertTrue(template.constant)
+        self.assertEqual(template.expand(3), "photo")
+
+    def test_counter(self):
+        self.assertEqual(engine.Template("img_%n").expand(7), "img_7")
+        self.assertEqual(engine.Template("img_%00n").expand(7), "img_007")
+
+    def test_fields(self):
+        template = engine.Template("%exif{%Y/%m}_%size")
+        self.assertEqual(template.fields, set([engine.FIELD_EXIF, engine.FIELD_SIZE]))
+        metadata = engine.FileMetadata(size=42, exif_date=datetime.datetime(2020, 5, 17))
+        self.assertEqual(template.expand(1, metadata), "2020-05_42")
+
+    def test_missing_metadata(self):
+        self.assertEqual(engine.Template("a%sizeb").expand(1), "ab")
+        self.assertEqual(engine.Template("%exif").expand(1, engine.FileMetadata()), "")
+
+    def test_exif_falls_back_to_mtime(self):
+        mtime = datetime.datetime(2019, 1, 2, 12).timestamp()
+        metadata = engine.FileMetadata(mtime=mtime)
+        self.assertEqual(engine.Template("%exif").expand(1, metadata), "2019-01-02")
+
+class OperationTest(unittest.TestCase):
+    def rename(self, operation, names, scope=engine.SCOPE_NAME_ONLY):
+        return list(engine.rename(RenameParams(operation, scope), names))
+
+    def test_replace_wildcard(self):
+        operation = engine.ReplaceOperation("IMG*", "photo")
+        self.assertEqual(self.rename(operation, ["IMG_01.jpg", "DSC.jpg"]), ["photo.jpg", "DSC.jpg"])
+
+    def test_replace_regex_counter(self):
+        operation = engine.ReplaceOperation(r"\d+", "%0n", regex=True, start=5, inc=2)
+        self.assertEqual(self.rename(operation, ["a1", "b2", "c3"]), ["a05", "b07", "c09"])
+
+    def test_replace_case_insensitive(self):
+        operation = engine.ReplaceOperation("img", "x", case=False)
+        self.assertEqual(self.rename(operation, ["IMG.png"]), ["x.png"])
+
+    def test_replace_invalid_regex(self):
+        operation = engine.ReplaceOperation("(", "x", regex=True)
+        self.assertEqual(self.rename(operation, ["a(b"]), ["a(b"])
+
+    def test_remove(self):
+        operation = engine.RemoveOperation(from_index=1, to_index=3)
+        self.assertEqual(self.rename(operation, ["abcdef.txt"]), ["cdef.txt"])
+        operation = engine.RemoveOperation(from_index=1, from_reverse=True, to_index=3, to_reverse=True)
+        self.assertEqual(self.rename(operation, ["abcdef.txt"]), ["abcd.txt"])
+
+    def test_insert(self):
+        operation = engine.InsertOperation("_%n", position=4, reverse=True)
+        self.assertEqual(self.rename(operation, ["abcdef.txt"]), ["abc_1def.txt"])
+        operation = engine.InsertOperation("XY", position=2, overwrite=True)
+        self.assertEqual(self.rename(operation, ["abcdef.txt"]), ["aXYdef.txt"])
+
+    def test_case(self):
+        operation = engine.CaseOperation(engine.CASE_UPPER)
+        self.assertEqual(self.rename(operation, ["photo.jpg"]), ["PHOTO.jpg"])
+        self.assertEqual(self.rename(operation, ["photo.jpg"], engine.SCOPE_EXTENSION_ONLY), ["photo.JPG"])
+        self.assertEqual(self.rename(operation, ["photo.jpg"], engine.SCOPE_ALL), ["PHOTO.JPG"])
+
+    def test_no_extension(self):
+        operation = engine.CaseOperation(engine.CASE_UPPER)
+        self.assertEqual(self.rename(operation, ["README"], engine.SCOPE_EXTENSION_ONLY), ["README"])
+
+class PlanTest(unittest.TestCase):
+    def test_apply(self):
+        plan = RenamePlan(RenameParams(engine.ReplaceOperation(" ", "_")))
+        self.assertEqual(plan.apply(1, "My Photo.jpg"), "My_Photo.jpg")
+
+    def test_start_index(self):
+        params = RenameParams(engine.InsertOperation("%n_"))
+        self.assertEqual(list(engine.rename(params, ["a", "b"], start_index=10)), ["10_a", "11_b"])
+
+    def test_lazy_names(self):
+        plan = RenamePlan(RenameParams(engine.CaseOperation(engine.CASE_UPPER)))
+        self.assertEqual(list(plan.rename(iter(["a", "b"]))), ["A", "B"])
+
+    def test_metadata(self):
+        plan = RenamePlan(RenameParams(engine.InsertOperation("%size_")))
+        self.assertEqual(plan.fields, set([engine.FIELD_SIZE]))
+        metadata = [engine.FileMetadata(size=1), engine.FileMetadata(size=2)]
+        self.assertEqual(list(plan.rename(["a", "b"], 1, metadata)), ["1_a", "2_b"])
+
+    def test_pipeline(self):
+        params = RenamePipeline([RenameParams(engine.ReplaceOperation(" ", "_")),
+                                 RenameParams(engine.CaseOperation(engine.CASE_LOWER), engine.SCOPE_ALL)])
+        plan = RenamePlan(params)
+        self.assertEqual(plan.apply(1, "My Photo.JPG"), "my_photo.jpg")
+
+    def test_pipeline_counter(self):
+        # Every step sees the same index
+        params = RenamePipeline([RenameParams(engine.InsertOperation("%n-")),
+                                 RenameParams(engine.InsertOperation("-%n", reverse=True, position=1))])
+        self.assertEqual(list(engine.rename(params, ["a", "b"])), ["1-a-1", "2-b-2"])
+
+    def test_key(self):
+        a = RenameParams(engine.ReplaceOperation("a", "b"))
+        b = RenameParams(engine.ReplaceOperation("a", "b"))
+        c = RenameParams(engine.ReplaceOperation("a", "b"), engine.SCOPE_ALL)
+        d = RenameParams(engine.ReplaceOperation("a", "c"))
+        self.assertEqual(a.key(), b.key())
+        self.assertNotEqual(a.key(), c.key())
+        self.assertNotEqual(a.key(), d.key())
+        self.assertEqual(RenamePipeline([a]).key(), a.key())
+        hash(RenamePipeline([a, c]).key())
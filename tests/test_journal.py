@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from helpers import rename_paths, temp_names
+import journal
+import scheduler
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = journal.RenameJournal(os.path.join(self.directory, "bulky", "journal"))
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_empty(self):
+        self.assertIsNone(self.journal.load())
+
+    def test_indices(self):
+        indices = self.journal.begin([[("a", "b"), ("c", "d")], [("e", "f")]])
+        self.assertEqual(indices, [[0, 1], [2]])
+
+    def test_complete(self):
+        self.journal.begin([[("a", "b"), ("c", "d")]])
+        self.journal.mark_done(0)
+        self.journal.mark_failed(1)
+        self.journal.end()
+        batch = self.journal.load()
+        self.assertFalse(batch.is_interrupted())
+        self.assertTrue(batch.can_undo())
+        self.assertEqual(batch.done, set([0]))
+        self.assertEqual(batch.failed, set([1]))
+        self.assertEqual(batch.get_undo_waves(batch.done), [[("b", "a")]])
+
+    def test_undone(self):
+        # c->a failed, the cycle was put back
+        self.journal.begin([[("a", ".tmp1")], [("c", "a")], [("b", "c")], [(".tmp1", "b")]])
+        self.journal.mark_done(0)
+        self.journal.mark_failed(1)
+        self.journal.mark_failed(2)
+        self.journal.mark_failed(3)
+        self.journal.mark_undone(0)
+        self.journal.end()
+        batch = self.journal.load()
+        self.assertFalse(batch.can_undo())
+        self.assertEqual(batch.get_remaining_waves(batch.done), [])
+
+    def test_undo_batch(self):
+        self.journal.begin([[("b", "a")]], undo=True)
+        self.journal.mark_done(0)
+        self.journal.end()
+        self.assertFalse(self.journal.load().can_undo())
+
+    def test_plan_not_written(self):
+        os.makedirs(os.path.dirname(self.journal.path))
+        with open(self.journal.path, "w") as f:
+            f.write('{"batch":"1","undo":false}\n{"old":"a","new":"b","wave":0}\n')
+        self.assertIsNone(self.journal.load())
+
+    def test_interrupted(self):
+        self.journal.begin([[("a", "b"), ("c", "d")], [("b", "c")]])
+        self.journal.mark_done(0)
+        self.journal.sync()
+        # Crash in the middle of a line
+        self.journal.file.write('{"do')
+        self.journal.close()
+
+        batch = self.journal.load()
+        self.assertTrue(batch.is_interrupted())
+        # c->d happened but wasn't recorded, b->c never started
+        existing = set(["b", "d"])
+        done = batch.recover(lambda uri: uri in existing)
+        self.assertEqual(done, set([0, 1]))
+        self.assertEqual(batch.get_undo_waves(done), [[("d", "c"), ("b", "a")]])
+        self.assertEqual(batch.get_remaining_waves(done), [[("b", "c")]])
+
+    def check_crashes(self, paths, renames):
+        # Interrupt the batch at every step: the outcomes of the waves that
+        # were complete are in the journal, the filesystem tells about the
+        # steps of the running wave.
+        waves = [[(step.source, step.target) for step in wave]
+                 for wave in scheduler.schedule(renames, temp_names())]
+        steps = [step for wave in waves for step in wave]
+        for crash in range(len(steps) + 1):
+            indices = self.journal.begin(waves)
+            for wave_indices in indices:
+                if wave_indices[-1] >= crash:
+                    break
+                for index in wave_indices:
+                    self.journal.mark_done(index)
+                self.journal.end_wave()
+            self.journal.close()
+            batch = self.journal.load()
+            existing = rename_paths(paths, steps[:crash])
+            self.assertEqual(batch.recover(lambda uri: uri in existing), set(range(crash)))
+
+    def test_recover_chain(self):
+        self.check_crashes(["f:///t/1", "f:///t/2", "f:///t/3"],
+                           [("f:///t/1", "f:///t/2", False, None),
+                            ("f:///t/2", "f:///t/3", False, None),
+                            ("f:///t/3", "f:///t/4", False, None)])
+
+    def test_recover_cycle(self):
+        self.check_crashes(["f:///t/a", "f:///t/b", "f:///t/c"],
+                           [("f:///t/a", "f:///t/b", False, None),
+                            ("f:///t/b", "f:///t/c", False, None),
+                            ("f:///t/c", "f:///t/a", False, None)])
+
+    def test_recover_directories(self):
+        self.check_crashes(["f:///t/d", "f:///t/d/x", "f:///t/d/e", "f:///t/d/e/y", "f:///t/z"],
+                           [("f:///t/d", "f:///t/z", True, None),
+                            ("f:///t/z", "f:///t/d", False, None),
+                            ("f:///t/d/e", "f:///t/d/E", True, None),
+                            ("f:///t/d/e/y", "f:///t/d/e/Y", False, None),
+                            ("f:///t/d/x", "f:///t/d/X", False, None)])
+
+    def test_killed(self):
+        # The outcomes of the waves that completed survive the process
+        # dying without closing the journal
+        pid = os.fork()
+        if pid == 0:
+            self.journal.begin([[("a", "b")], [("c", "a")]])
+            self.journal.mark_done(0)
+            self.journal.end_wave()
+            self.journal.mark_done(1)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        batch = self.journal.load()
+        self.assertTrue(batch.is_interrupted())
+        self.assertEqual(batch.done, set([0]))
+
+    def test_may_be_interrupted(self):
+        self.assertFalse(self.journal.may_be_interrupted())
+        self.journal.begin([[("a", "b")] * 1000])
+        self.assertTrue(self.journal.may_be_interrupted())
+        self.journal.end()
+        self.assertFalse(self.journal.may_be_interrupted())
@@ -0,0 +1,107 @@
+import datetime
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import metadata
+
+def make_tiff(order, date_time=None, date_time_original=None):
+    # A TIFF structure with the dates in IFD0 and in the EXIF IFD,
+    # order is "<" (II) or ">" (MM)
+    ifd0 = []
+    exif = []
+    if date_time is not None:
+        ifd0.append((metadata.TAG_DATE_TIME, date_time))
+    if date_time_original is not None:
+        exif.append((metadata.TAG_DATE_TIME_ORIGINAL, date_time_original))
+
+    exif_offset = 8 + 2 + 12 * (len(ifd0) + (1 if exif else 0)) + 4
+    data_offset = exif_offset + (2 + 12 * len(exif) + 4 if exif else 0)
+    data = []
+
+    def pack_ifd(dates, extra=None):
+        nonlocal data_offset
+        entries = []
+        for tag, text in dates:
+            value = text.encode() + b"\0"
+            entries.append(struct.pack(order + "HHII", tag, metadata.TYPE_ASCII, len(value), data_offset))
+            data.append(value)
+            data_offset += len(value)
+        if extra is not None:
+            entries.append(extra)
+        return struct.pack(order + "H", len(entries)) + b"".join(entries) + struct.pack(order + "I", 0)
+
+    pointer = None
+    if exif:
+        pointer = struct.pack(order + "HHII", metadata.TAG_EXIF_IFD, 4, 1, exif_offset)
+    header = (b"II*\0" if order == "<" else b"MM\0*") + struct.pack(order + "I", 8)
+    ifds = pack_ifd(ifd0, pointer)
+    if exif:
+        ifds += pack_ifd(exif)
+    return header + ifds + b"".join(data)
+
+def make_jpeg(tiff):
+    # An APP0 (JFIF) segment, then APP1 with the EXIF data
+    app0 = b"JFIF\0\1\1\0\0\1\0\1\0\0"
+    app1 = b"Exif\0\0" + tiff
+    return b"".join([b"\xff\xd8",
+                     b"\xff\xe0", struct.pack(">H", len(app0) + 2), app0,
+                     b"\xff\xe1", struct.pack(">H", len(app1) + 2), app1,
+                     b"\xff\xda\0\2", b"\xff\xd9"])
+
+class ExifTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_tiff_little_endian(self):
+        path = self.write("a.dng", make_tiff("<", "2001:01:01 00:00:00", "2020:05:17 10:11:12"))
+        self.assertEqual(metadata.read_exif_date(path), datetime.datetime(2020, 5, 17, 10, 11, 12))
+
+    def test_tiff_big_endian(self):
+        path = self.write("a.nef", make_tiff(">", "2001:01:01 00:00:00", "2020:05:17 10:11:12"))
+        self.assertEqual(metadata.read_exif_date(path), datetime.datetime(2020, 5, 17, 10, 11, 12))
+
+    def test_jpeg(self):
+        for order in ("<", ">"):
+            path = self.write("a.jpg", make_jpeg(make_tiff(order, None, "2018:12:31 23:59:58")))
+            self.assertEqual(metadata.read_exif_date(path), datetime.datetime(2018, 12, 31, 23, 59, 58))
+
+    def test_falls_back_to_date_time(self):
+        path = self.write("a.jpg", make_jpeg(make_tiff(">", "2015:06:07 08:09:10")))
+        self.assertEqual(metadata.read_exif_date(path), datetime.datetime(2015, 6, 7, 8, 9, 10))
+
+    def test_unset_date(self):
+        path = self.write("a.tif", make_tiff("<", "2015:06:07 08:09:10", "0000:00:00 00:00:00"))
+        self.assertEqual(metadata.read_exif_date(path), datetime.datetime(2015, 6, 7, 8, 9, 10))
+
+    def test_no_date(self):
+        path = self.write("a.tif", make_tiff("<"))
+        self.assertIsNone(metadata.read_exif_date(path))
+
+    def test_truncated(self):
+        data = make_jpeg(make_tiff("<", None, "2018:12:31 23:59:58"))
+        path = self.write("a.jpg", data[:40])
+        with self.assertRaises(metadata.ExifError):
+            metadata.read_exif_date(path)
+        self.assertEqual(metadata.read_exif_dates([path]), [None])
+
+    def test_not_an_image(self):
+        path = self.write("a.txt", b"hello")
+        self.assertIsNone(metadata.read_exif_date(path))
+
+    def test_read_exif_dates(self):
+        good = self.write("a.jpg", make_jpeg(make_tiff("<", "2015:06:07 08:09:10")))
+        missing = os.path.join(self.directory, "missing.jpg")
+        self.assertEqual(metadata.read_exif_dates([good, missing]),
+                         [datetime.datetime(2015, 6, 7, 8, 9, 10), None])
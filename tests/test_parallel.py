@@ -0,0 +1,47 @@
+import multiprocessing
+import threading
+import time
+import unittest
+
+from engine import RenameParams, ReplaceOperation
+import parallel
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        # Runs the worker side in this process
+        self.generation = multiprocessing.Value("q", 0)
+        self.started = multiprocessing.Value("d", 0)
+        parallel.init_worker(self.generation, self.started)
+        self.params = RenameParams(ReplaceOperation(r"(a+)+$", "x", regex=True))
+
+    def test_rename(self):
+        params = RenameParams(ReplaceOperation(r"a+", "x", regex=True))
+        self.assertEqual(parallel.rename_chunk(params, 1, ["aab", "b"], None, 0, 1), ["xb", "b"])
+
+    def test_budget(self):
+        start = time.monotonic()
+        with self.assertRaises(parallel.RegexTimeout):
+            parallel.rename_chunk(self.params, 1, ["a" * 40 + "b"], None, 0, 0.5)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_deadline_passed(self):
+        self.started.value = time.monotonic() - 1
+        start = time.monotonic()
+        with self.assertRaises(parallel.RegexTimeout):
+            parallel.rename_chunk(self.params, 1, ["a" * 40 + "b"], None, 0, 0.5)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_stale_generation(self):
+        self.generation.value = 1
+        self.assertIsNone(parallel.rename_chunk(self.params, 1, ["a" * 40 + "b"], None, 0, 0.5))
+
+    def test_cancelled_while_running(self):
+        def cancel():
+            with self.generation.get_lock():
+                self.generation.value += 1
+        timer = threading.Timer(0.2, cancel)
+        timer.start()
+        start = time.monotonic()
+        self.assertIsNone(parallel.rename_chunk(self.params, 1, ["a" * 40 + "b"], None, 0, None))
+        self.assertLess(time.monotonic() - start, 2)
+        timer.join()
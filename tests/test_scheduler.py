@@ -0,0 +1,100 @@
+import unittest
+
+from helpers import rename_paths, temp_names
+import scheduler
+
+def apply(paths, waves):
+    # Run the waves on a set of uris. Steps of a wave must not depend on
+    # each other: they're all checked against the state before the wave.
+    for wave in waves:
+        for step in wave:
+            assert step.source in paths, "%s doesn't exist" % step.source
+            assert step.target not in paths, "%s already exists" % step.target
+        paths = rename_paths(paths, [(step.source, step.target) for step in wave])
+    return paths
+
+class ScheduleTest(unittest.TestCase):
+    def check(self, paths, renames, expected):
+        waves = scheduler.schedule(renames, temp_names())
+        self.assertEqual(apply(paths, waves), set(expected))
+        return waves
+
+    def test_independent(self):
+        waves = self.check(["file:///t/a", "file:///t/b"],
+                           [("file:///t/a", "file:///t/c", False, None),
+                            ("file:///t/b", "file:///t/d", False, None)],
+                           ["file:///t/c", "file:///t/d"])
+        self.assertEqual(len(waves), 1)
+
+    def test_unchanged(self):
+        self.assertEqual(scheduler.schedule([("file:///t/a", "file:///t/a", False, None)]), [])
+
+    def test_chain(self):
+        waves = self.check(["file:///t/a", "file:///t/b"],
+                           [("file:///t/a", "file:///t/b", False, "a"),
+                            ("file:///t/b", "file:///t/c", False, "b")],
+                           ["file:///t/b", "file:///t/c"])
+        self.assertEqual([[step.data for step in wave] for wave in waves], [["b"], ["a"]])
+
+    def test_swap(self):
+        waves = self.check(["file:///t/a", "file:///t/b"],
+                           [("file:///t/a", "file:///t/b", False, "a"),
+                            ("file:///t/b", "file:///t/a", False, "b")],
+                           ["file:///t/a", "file:///t/b"])
+        steps = [step for wave in waves for step in wave]
+        # One temporary name, the data is only on the final steps
+        self.assertEqual(len(steps), 3)
+        self.assertEqual(sorted(step.data for step in steps if step.data is not None), ["a", "b"])
+
+    def test_chain_links(self):
+        # A failed step stops the rest of its chain, a cycle is put back
+        waves = self.check(["file:///t/a", "file:///t/b", "file:///t/c", "file:///t/x"],
+                           [("file:///t/a", "file:///t/b", False, None),
+                            ("file:///t/b", "file:///t/c", False, None),
+                            ("file:///t/c", "file:///t/a", False, None),
+                            ("file:///t/x", "file:///t/y", False, None)],
+                           ["file:///t/a", "file:///t/b", "file:///t/c", "file:///t/y"])
+        steps = [step for wave in waves for step in wave]
+        single = [step for step in steps if step.source == "file:///t/x"][0]
+        self.assertIsNone(single.previous)
+        self.assertFalse(single.rollback)
+        cycle = [step for step in steps if step is not single]
+        self.assertIsNone(cycle[0].previous)
+        for previous, step in zip(cycle, cycle[1:]):
+            self.assertIs(step.previous, previous)
+        self.assertEqual(cycle[0].target, cycle[-1].source)
+        self.assertEqual([step.rollback for step in cycle], [False, False, False, True])
+
+    def test_shift(self):
+        paths = ["file:///t/%d" % i for i in range(1, 6)]
+        renames = [("file:///t/%d" % i, "file:///t/%d" % (i + 1), False, None) for i in range(1, 6)]
+        waves = self.check(paths, renames, ["file:///t/%d" % i for i in range(2, 7)])
+        self.assertEqual(len(waves), 5)
+
+    def test_directory_after_contents(self):
+        self.check(["file:///t/d", "file:///t/d/a", "file:///t/d/e", "file:///t/d/e/b"],
+                   [("file:///t/d", "file:///t/D", True, None),
+                    ("file:///t/d/e", "file:///t/d/E", True, None),
+                    ("file:///t/d/e/b", "file:///t/d/e/B", False, None),
+                    ("file:///t/d/a", "file:///t/d/A", False, None)],
+                   ["file:///t/D", "file:///t/D/A", "file:///t/D/E", "file:///t/D/E/B"])
+
+    def test_file_takes_directory_name(self):
+        self.check(["file:///t/x", "file:///t/d"],
+                   [("file:///t/x", "file:///t/d", False, None),
+                    ("file:///t/d", "file:///t/e", True, None)],
+                   ["file:///t/d", "file:///t/e"])
+
+    def test_directory_takes_file_name(self):
+        self.check(["file:///t/x", "file:///t/d", "file:///t/d/f"],
+                   [("file:///t/d", "file:///t/x", True, None),
+                    ("file:///t/x", "file:///t/y", False, None),
+                    ("file:///t/d/f", "file:///t/d/g", False, None)],
+                   ["file:///t/x", "file:///t/x/g", "file:///t/y"])
+
+    def test_file_directory_swap(self):
+        self.check(["file:///t/x", "file:///t/d", "file:///t/d/f"],
+                   [("file:///t/d", "file:///t/x", True, None),
+                    ("file:///t/x", "file:///t/d", False, None),
+                    ("file:///t/d/f", "file:///t/d/g", False, None)],
+                   ["file:///t/d", "file:///t/x", "file:///t/x/g"])
@@ -3,12 +3,18 @@ import gettext
 import gi
 import locale
 import os
-import re
 import setproctitle
 import warnings
 import sys
-import functools
-import unidecode
+import collections
+
+import engine
+import pathlist
+import scheduler
+import tracing
+# journal, metadata, parallel, renamer and scanner aren't needed to show
+# the window, they're imported when first used.
+from engine import SCOPE_NAME_ONLY, SCOPE_ALL
 
 # Suppress GTK deprecation warnings
 warnings.filterwarnings("ignore")
@@ -16,8 +22,6 @@ warnings.filterwarnings("ignore")
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk, Gio, GdkPixbuf, GLib
 
-setproctitle.setproctitle("bulky")
-
 # i18n
 APP = 'bulky'
 LOCALE_DIR = "/usr/share/locale"
@@ -26,15 +30,73 @@ gettext.bindtextdomain(APP, LOCALE_DIR)
 gettext.textdomain(APP)
 _ = gettext.gettext
 
-COL_ICON, COL_NAME, COL_NEW_NAME, COL_FILE, COL_PIXBUF = range(5)
-SCOPE_NAME_ONLY = "name"
-SCOPE_EXTENSION_ONLY = "extension"
-SCOPE_ALL = "all"
+COL_ICON, COL_NAME, COL_NEW_NAME, COL_FILE = range(4)
+
+# The window layout, can be pointed at a source tree (see benchmark)
+UI_FILE = "/usr/share/bulky/bulky.ui"
 
 SETTINGS_SCHEMA_ID = "org.x.bulky"
 MRU_OPERATION = "mru-operation"
 MRU_SCOPE = "mru-scope"
 
+FILE_ATTRIBUTES = ",".join([
+    "standard::type",
+    "standard::icon",
+    "standard::edit-name",
+    "access::can-write",
+    "thumbnail::path",
+    "thumbnail::is-valid",
+    "time::modified",
+    "standard::size"
+])
+
+# Folder enumeration also needs the names and hidden flags
+SCAN_ATTRIBUTES = FILE_ATTRIBUTES + ",standard::name,standard::is-hidden"
+
+ICON_GENERIC = Gio.ThemedIcon.new("text-x-generic")
+ICON_FOLDER = Gio.ThemedIcon.new("folder")
+
+# Number of directories listed concurrently to check for existing files
+DIRECTORY_LIST_MAX_PENDING = 4
+# Number of names requested at a time while listing them
+DIRECTORY_LIST_BATCH_SIZE = 1000
+
+# Number of query_info_async calls kept in flight while loading
+LOAD_MAX_PENDING = 64
+# File lists are only read further while fewer files than this are queued
+LOAD_MAX_QUEUED = 10000
+
+# Loads of at least this many files are added with the model detached
+MODEL_DETACH_ROWS = 1000
+
+# Thumbnails
+THUMBNAIL_CACHE_BYTES = 32 * 1024 * 1024
+THUMBNAIL_MAX_PENDING = 4
+
+# Rename journal recovery
+RESPONSE_ROLL_BACK = 1
+RESPONSE_FINISH = 2
+
+# How long an instance started with --service waits for a new launch
+# once its window is closed
+SERVICE_INACTIVITY_TIMEOUT_MS = 10 * 60 * 1000
+
+# EXIF dates are read by this many threads, in chunks of files
+METADATA_WORKERS = 4
+METADATA_CHUNK_SIZE = 256
+
+# Memory used by cached previews
+PREVIEW_CACHE_BYTES = 64 * 1024 * 1024
+
+# Time the workers can spend on regular expressions for a preview before
+# they're stopped
+REGEX_TIME_BUDGET_MS = 3000
+
+# Preview scheduling
+PREVIEW_WAIT = object() # yielded by the preview job while waiting for the workers
+PREVIEW_DEBOUNCE_MS = 150
+PREVIEW_CHUNK_USEC = 10000
+
 class FolderFileChooserDialog(Gtk.Dialog):
     def __init__(self, window_title, transient_parent, starting_location):
         super(FolderFileChooserDialog, self).__init__(title=window_title,
@@ -64,91 +126,170 @@ class FolderFileChooserDialog(Gtk.Dialog):
 
         return Gdk.EVENT_PROPAGATE
 
+class FolderImportDialog(Gtk.Dialog):
+    def __init__(self, window_title, transient_parent, starting_location):
+        super(FolderImportDialog, self).__init__(title=window_title,
+                                                 parent=transient_parent,
+                                                 default_width=750,
+                                                 default_height=550)
+
+        self.add_buttons(_("Cancel"), Gtk.ResponseType.CANCEL,
+                         _("Add"), Gtk.ResponseType.OK)
+
+        self.chooser = Gtk.FileChooserWidget(action=Gtk.FileChooserAction.SELECT_FOLDER, select_multiple=True)
+        self.chooser.set_current_folder_file(starting_location)
+
+        grid = Gtk.Grid(row_spacing=6, column_spacing=12, border_width=12)
+        label = Gtk.Label(label=_("Include:"), xalign=0)
+        self.include_entry = Gtk.Entry(hexpand=True, placeholder_text=_("All files, or patterns such as *.jpg, *.png"))
+        grid.attach(label, 0, 0, 1, 1)
+        grid.attach(self.include_entry, 1, 0, 3, 1)
+        label = Gtk.Label(label=_("Exclude:"), xalign=0)
+        self.exclude_entry = Gtk.Entry(hexpand=True, placeholder_text=_("Patterns such as *.tmp, .git"))
+        grid.attach(label, 0, 1, 1, 1)
+        grid.attach(self.exclude_entry, 1, 1, 3, 1)
+        label = Gtk.Label(label=_("Depth:"), xalign=0)
+        self.depth_spin = Gtk.SpinButton.new_with_range(0, 1000, 1)
+        self.depth_spin.set_tooltip_text(_("How many levels of subfolders to descend into, 0 for no limit."))
+        grid.attach(label, 0, 2, 1, 1)
+        grid.attach(self.depth_spin, 1, 2, 1, 1)
+        self.hidden_check = Gtk.CheckButton(label=_("Include hidden files"))
+        grid.attach(self.hidden_check, 2, 2, 1, 1)
+        self.folders_check = Gtk.CheckButton(label=_("Add the folders too"))
+        grid.attach(self.folders_check, 3, 2, 1, 1)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box.pack_start(self.chooser, True, True, 0)
+        box.pack_start(grid, False, False, 0)
+        box.show_all()
+
+        self.get_content_area().add(box)
+        self.get_content_area().set_border_width(0)
+        self.get_files = self.chooser.get_files
+        self.get_current_folder_file = self.chooser.get_current_folder_file
+
+    def get_options(self):
+        import scanner
+        return scanner.ScanOptions(max_depth=self.depth_spin.get_value_as_int(),
+                                   include=scanner.parse_patterns(self.include_entry.get_text()),
+                                   exclude=scanner.parse_patterns(self.exclude_entry.get_text()),
+                                   hidden=self.hidden_check.get_active(),
+                                   folders=self.folders_check.get_active())
+
 # This is a data structure representing
 # the file object
+# Icons are shared by many rows, keep a single instance of each
+_icons = {}
+
+def get_shared_icon(icon):
+    key = icon.to_string()
+    if key is None:
+        return icon
+    return _icons.setdefault(key, icon)
+
+# Characters Gio leaves unescaped in the path of a file:// URI, besides the
+# unreserved ones
+URI_PATH_ALLOWED = "!$&'()*+,=:@"
+
+# One per loaded row, so only the fields we use are kept, in slots.
+# The Gio.File is recreated from the URI when needed, the preview works on
+# the URI strings, the parent's being shared by the rows of a directory.
 class FileObject():
-    def __init__(self, path_or_uri, scale):
-        self.gfile = self.create_gfile(path_or_uri)
-        self.scale = scale
-        self._update_info()
+    __slots__ = ("uri", "parent_uri", "name", "icon", "thumb_path", "is_dir", "can_write", "is_valid",
+                 "mtime", "size", "exif_date", "exif_read")
+
+    def __init__(self, path_or_uri, info=None):
+        gfile = self.create_gfile(path_or_uri)
+        if info is None:
+            info = self._query_info(gfile)
+        self._set_info(gfile, info)
+
+    @property
+    def gfile(self):
+        return Gio.File.new_for_uri(self.uri)
 
-    def create_gfile(self, path_or_uri):
+    @staticmethod
+    def create_gfile(path_or_uri):
         gfile = None
 
-        if "://" in path_or_uri:
+        if isinstance(path_or_uri, Gio.File):
+            gfile = path_or_uri
+        elif "://" in path_or_uri:
             gfile = Gio.File.new_for_uri(path_or_uri)
         else:
             gfile = Gio.File.new_for_path(path_or_uri)
 
         return gfile
 
-    def _update_info(self):
-        self.info = None
-        self.uri = self.gfile.get_uri()
-        self.name = self.gfile.get_basename() # temp in case query_info fails to get edit-name
-        self.icon = Gio.ThemedIcon.new("text-x-generic")
-        self.pixbuf = None
-
-        attrs = ",".join([
-            "standard::type",
-            "standard::icon",
-            "standard::edit-name",
-            "access::can-write",
-            "thumbnail::path",
-            "thumbnail::is-valid"
-        ])
-
+    @staticmethod
+    def _query_info(gfile):
         try:
-            self.info = self.gfile.query_info(attrs, Gio.FileQueryInfoFlags.NONE, None)
-            self.name = self.info.get_edit_name()
-
-            if self.info.get_file_type() == Gio.FileType.DIRECTORY:
-                self.icon = Gio.ThemedIcon.new("folder")
-            else:
-                thumb_ok = self.info.get_attribute_boolean("thumbnail::is-valid")
-
-                if thumb_ok:
-                    thumb_path = self.info.get_attribute_byte_string("thumbnail::path")
-                    if thumb_path and os.path.exists(thumb_path):
-                        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(thumb_path, 22 *  self.scale, 22 * self.scale, True)
-                        if pixbuf is not None:
-                            self.pixbuf = pixbuf
-
-                info_icon = self.info.get_icon()
-
-                if info_icon:
-                    self.icon = info_icon
-                else:
-                    self.icon = Gio.ThemedIcon.new("text-x-generic")
+            with tracing.span("FileObject._query_info"):
+                return gfile.query_info(FILE_ATTRIBUTES, Gio.FileQueryInfoFlags.NONE, None)
         except GLib.Error as e:
             if e.code == Gio.IOErrorEnum.NOT_FOUND:
-                print("file %s does not exist" % self.uri)
+                print("file %s does not exist" % gfile.get_uri())
             else:
                 print(e.message)
+            return None
+
+    def _set_info(self, gfile, info):
+        self.set_uri(gfile.get_uri())
+        self.name = gfile.get_basename() # temp in case query_info fails to get edit-name
+        self.icon = ICON_GENERIC
+        self.thumb_path = None
+        self.is_dir = False
+        self.can_write = False
+        self.mtime = None
+        self.size = None
+        self.exif_date = None
+        self.exif_read = False # EXIF dates are read in the background, when needed
+
+        if info is None:
             self.is_valid = False
             return
 
+        self.name = info.get_edit_name()
+        self.can_write = info.get_attribute_boolean("access::can-write")
+        if info.has_attribute("time::modified"):
+            self.mtime = info.get_attribute_uint64("time::modified")
+        if info.has_attribute("standard::size"):
+            self.size = info.get_size()
+
+        if info.get_file_type() == Gio.FileType.DIRECTORY:
+            self.is_dir = True
+            self.icon = ICON_FOLDER
+        else:
+            thumb_ok = info.get_attribute_boolean("thumbnail::is-valid")
+
+            if thumb_ok:
+                # The thumbnail itself is only decoded once the row is drawn
+                self.thumb_path = info.get_attribute_byte_string("thumbnail::path")
+
+            info_icon = info.get_icon()
+
+            if info_icon:
+                self.icon = get_shared_icon(info_icon)
+
         self.is_valid = True
 
-    def rename(self, new_name):
-        backup_gfile = self.gfile.dup()
-        try:
-            new_gfile = self.gfile.set_display_name(new_name, None)
-        except:
-            # This can fail - make sure the GFile is still in a pre-fail state
-            # (not sure this is necessary), then let the caller handle telling
-            # the user.
-            self.gfile = backup_gfile
-            raise
+    def get_metadata(self):
+        return engine.FileMetadata(self.mtime, self.size, self.exif_date)
 
-        self.gfile = new_gfile
-        self._update_info()
+    def set_uri(self, uri):
+        self.uri = uri
+        self.parent_uri = sys.intern(scheduler.split_uri(uri)[0])
 
-        return True
+    def set_renamed(self, new_gfile, new_name):
+        # Called once the file was renamed, the rest of the info is still valid
+        self.set_uri(new_gfile.get_uri())
+        self.name = new_name
 
     def get_pending_uri(self, new_name):
-        parent = self.gfile.get_parent()
-        return parent.get_child(new_name).get_uri()
+        if self.uri.startswith("file://"):
+            return self.parent_uri + "/" + GLib.Uri.escape_string(new_name, URI_PATH_ALLOWED, False)
+        # Other backends may escape names their own way
+        return self.gfile.get_parent().get_child(new_name).get_uri()
 
     def get_path_or_uri_for_display(self):
         if self.uri.startswith("file://"):
@@ -165,59 +306,313 @@ class FileObject():
             return parent.get_basename()
 
     def writable(self):
-        if self.gfile.is_native():
-            return self.info.get_attribute_boolean("access::can-write")
+        if self.uri.startswith("file://"):
+            return self.can_write
         # For non-native (remote) files, optimistically assume writable
         return True
 
-    def parent_writable(self):
-        parent = self.gfile.get_parent()
-
-        if parent.equal(self.gfile):
+    def parent_writable(self, directory_cache):
+        if self.uri.endswith("/"):
+            # The root, it has no parent
             return False
 
-        parent_fileobj = FileObject(parent.get_uri(), self.scale)
-        return parent_fileobj.writable()
+        return directory_cache.is_writable(self.parent_uri)
 
     def is_a_dir(self):
-        return self.info.get_file_type() == Gio.FileType.DIRECTORY
+        return self.is_dir
+
+# Attributes of the parent directories of the loaded files, keyed by URI,
+# so rows sharing a directory don't each query it on every preview pass.
+#
+# It also keeps the contents of these directories, so new names can be
+# checked against the files already on disk. Each directory is listed once,
+# asynchronously, and the listings are kept up to date as we rename.
+class DirectoryCache():
+    def __init__(self, listed_callback):
+        self.writable = {}
+        self.names = {} # uri -> set of the escaped child names, None while listing
+        self.list_queue = collections.deque()
+        self.list_pending = 0
+        self.cancellable = Gio.Cancellable()
+        self.listed_callback = listed_callback # called whenever a listing completes
+
+    def is_writable(self, uri):
+        writable = self.writable.get(uri)
+        if writable is None:
+            if uri.startswith("file://"):
+                try:
+                    gfile = Gio.File.new_for_uri(uri)
+                    info = gfile.query_info("access::can-write", Gio.FileQueryInfoFlags.NONE, None)
+                    writable = info.get_attribute_boolean("access::can-write")
+                except GLib.Error as e:
+                    print(e.message)
+                    writable = False
+            else:
+                # For non-native (remote) files, optimistically assume writable
+                writable = True
+            self.writable[uri] = writable
+        return writable
+
+    def get_names(self, uri):
+        # Return the names in the directory, or None if it's not listed yet,
+        # in which case the listing is started.
+        if uri in self.names:
+            return self.names[uri]
+        self.names[uri] = None
+        self.list_queue.append(uri)
+        self.process_list_queue()
+        return None
+
+    def is_listing(self):
+        return self.list_pending > 0 or len(self.list_queue) > 0
+
+    def process_list_queue(self):
+        while self.list_pending < DIRECTORY_LIST_MAX_PENDING and len(self.list_queue) > 0:
+            uri = self.list_queue.popleft()
+            self.list_pending += 1
+            directory = Gio.File.new_for_uri(uri)
+            directory.enumerate_children_async("standard::name", Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS,
+                                               GLib.PRIORITY_LOW, self.cancellable, self.on_enumerate_children,
+                                               (self.cancellable, directory, set()))
+
+    def on_enumerate_children(self, directory, result, data):
+        try:
+            enumerator = directory.enumerate_children_finish(result)
+        except GLib.Error as e:
+            self.finish_listing(data, e)
+            return
+        enumerator.next_files_async(DIRECTORY_LIST_BATCH_SIZE, GLib.PRIORITY_LOW, data[0],
+                                    self.on_next_files, data)
 
+    def on_next_files(self, enumerator, result, data):
+        cancellable, directory, names = data
+        try:
+            infos = enumerator.next_files_finish(result)
+            error = None
+        except GLib.Error as e:
+            infos = []
+            error = e
+        if len(infos) == 0:
+            try:
+                enumerator.close(None)
+            except GLib.Error:
+                pass
+            self.finish_listing(data, error)
+            return
+        for info in infos:
+            # Names are kept the way they appear in URIs, like the targets we check
+            names.add(directory.get_child(info.get_name()).get_uri().rsplit("/", 1)[1])
+        enumerator.next_files_async(DIRECTORY_LIST_BATCH_SIZE, GLib.PRIORITY_LOW, cancellable,
+                                    self.on_next_files, data)
+
+    def finish_listing(self, data, error=None):
+        cancellable, directory, names = data
+        if cancellable.is_cancelled():
+            # Invalidated in the meantime
+            return
+        self.list_pending -= 1
+        if error is not None:
+            # Renaming will report the actual problem, if any
+            print(error.message)
+        self.names[directory.get_uri()] = names
+        self.process_list_queue()
+        self.listed_callback()
+
+    def rename(self, old_uri, new_uri):
+        # Keep the listings in sync after a file was renamed
+        parent, old_name = scheduler.split_uri(old_uri)
+        names = self.names.get(parent)
+        if names is not None:
+            names.discard(old_name)
+            names.add(scheduler.split_uri(new_uri)[1])
+        if old_uri in self.names:
+            # A directory, its subdirectories get listed again if needed
+            self.names[new_uri] = self.names.pop(old_uri)
+            prefix = old_uri + "/"
+            for uri in [uri for uri in self.names if uri.startswith(prefix)]:
+                del self.names[uri]
+
+    def invalidate_writable(self):
+        self.writable.clear()
+
+    def invalidate(self):
+        self.writable.clear()
+        self.names.clear()
+        self.list_queue.clear()
+        self.list_pending = 0
+        self.cancellable.cancel()
+        self.cancellable = Gio.Cancellable()
+
+# LRU cache bounded by the memory footprint of its values (thumbnail
+# surfaces, preview results)
+class LRUCache():
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict() # key -> (value, size)
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def insert(self, key, value, size):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, (value, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+# Only one instance runs: later launches hand their files over to it and
+# exit straight away. In service mode the instance stays around for a while
+# after the window is closed, so the next launch doesn't pay the startup.
 class MyApplication(Gtk.Application):
     # Main initialization routine
-    def __init__(self, application_id, flags):
+    def __init__(self, application_id, flags, service=False):
         Gtk.Application.__init__(self, application_id=application_id, flags=flags)
+        self.service = service
+        self.main_window = None
+        # Owned here rather than by the window: a batch must finish before
+        # the window goes, and only one batch writes to the journal.
+        self.rename_executor = None # the batch running, if any
+        self.journal = None # see get_journal()
+        if service:
+            self.set_inactivity_timeout(SERVICE_INACTIVITY_TIMEOUT_MS)
         self.connect("activate", self.activate)
+        self.connect("open", self.open)
+        self.connect("command-line", self.command_line)
 
     def activate(self, application):
-        windows = self.get_windows()
-        if (len(windows) > 0):
-            window = windows[0]
-            window.present()
-            window.show()
+        self.present_window([])
+
+    def open(self, application, files, n_files, hint):
+        self.present_window(files)
+
+    def command_line(self, application, command_line):
+        # Runs in the primary instance, for its own arguments and for those
+        # of every later launch. Relative paths are resolved against the
+        # working directory of the launch they come from.
+        #
+        # --from-file FILE reads a list of files from FILE (- for stdin),
+        # one per line, or NUL-separated with -0/--null.
+        files = []
+        lists = []
+        null_separated = False
+        arguments = command_line.get_arguments()[1:]
+        while len(arguments) > 0:
+            argument = arguments.pop(0)
+            if argument in ("-0", "--null"):
+                null_separated = True
+            elif argument == "--from-file" and len(arguments) > 0:
+                stream = self.open_file_list(command_line, arguments.pop(0))
+                if stream is not None:
+                    lists.append(stream)
+            else:
+                files.append(command_line.create_file_for_arg(argument))
+
+        if len(files) > 0 or len(lists) > 0 or command_line.get_is_remote() or not self.service:
+            self.present_window(files, lists, null_separated)
         else:
-            window = MainWindow(self)
-            self.add_window(window.window)
-            window.window.show()
+            # Started as a service: the inactivity timeout only starts counting
+            # once the application is released, without this run() returns at once.
+            self.hold()
+            self.release()
+        return 0
+
+    def open_file_list(self, command_line, name):
+        if name == "-":
+            stream = command_line.get_stdin()
+            if stream is None:
+                print("Unable to read the file list from stdin")
+            return stream
+        try:
+            return command_line.create_file_for_arg(name).read(None)
+        except GLib.Error as e:
+            print("Unable to read the file list %s: %s" % (name, e.message))
+            return None
+
+    def present_window(self, files, lists=None, null_separated=False):
+        if self.main_window is None:
+            self.main_window = MainWindow(self, files)
+            self.add_window(self.main_window.window)
+            self.main_window.window.connect("destroy", self.on_window_destroyed)
+            self.main_window.window.show()
+        else:
+            if len(files) > 0:
+                self.main_window.load_files(files)
+            self.main_window.window.present()
+        for stream in lists or []:
+            self.main_window.read_file_list(stream, null_separated)
+
+    def on_window_destroyed(self, window):
+        self.main_window = None
+
+    def get_journal(self):
+        if self.journal is None:
+            import journal
+            self.journal = journal.RenameJournal(os.path.join(GLib.get_user_data_dir(), "bulky", "journal"))
+        return self.journal
 
 class MainWindow():
 
-    def __init__(self, application):
+    def __init__(self, application, files=None):
 
         self.application = application
         self.settings = Gio.Settings(schema_id="org.x.bulky")
         self.icon_theme = Gtk.IconTheme.get_default()
-        self.operation_function = self.replace_text
+        self.operation = "replace"
         self.scope = SCOPE_NAME_ONLY
+        self.steps = [] # (label, RenameParams) of the operations applied before the current one
+        self.plan = None
+        self.preview_job = None
+        self.preview_source_id = None
+        self.load_queue = collections.deque()
+        self.load_cancellable = None
+        self.load_pending = 0
+        self.load_total = 0
+        self.load_done = 0
+        self.load_batch = []
+        self.load_flush_id = None
+        self.load_detached_sort = None # (column, order) while the model is detached
+        self.load_scanners = set()
+        self.load_readers = set()
+        self.load_trace = None
+        self.preview_trace = None
+        self.rename_trace = None
+        self.close_after_rename = None # called once the batch was cancelled, see confirm_close()
+        self.thumbnail_cache = LRUCache(THUMBNAIL_CACHE_BYTES)
+        # New names of whole previews, by rows version and operation settings
+        self.preview_cache = LRUCache(PREVIEW_CACHE_BYTES)
+        self.rows_version = 0
+        # Worker processes for large, expensive previews
+        self.preview_pool = None # see get_preview_pool()
+        self.preview_pool_request = None # identifies the pool request the preview waits for
+        self.preview_pool_result = None # (names, error)
+        self.directory_cache = DirectoryCache(self.on_directory_listed)
+        self.metadata_executor = None # created when EXIF dates are first needed
+        self.exif_reading = set() # file objects whose EXIF date is being read
+        self.thumbnail_queue = collections.deque()
+        self.thumbnail_requests = set() # keys queued or being decoded
+        self.thumbnail_pending = 0
         # used to prevent collisions
-        self.uris = []
-        self.renamed_uris = []
+        self.uris = {} # uri -> iter of every loaded row
+        self.pending_uris = {} # target uri -> iters of the rows renamed to it
+        self.collision_uris = set() # uris of the rows involved in a collision
         self.last_chooser_location = Gio.File.new_for_path(GLib.get_home_dir())
 
         # Set the Glade file
-        gladefile = "/usr/share/bulky/bulky.ui"
         self.builder = Gtk.Builder()
         self.builder.set_translation_domain(APP)
-        self.builder.add_from_file(gladefile)
+        self.builder.add_from_file(UI_FILE)
         self.window = self.builder.get_object("main_window")
         self.window.set_title(_("Rename..."))
         self.window.set_icon_name("bulky")
@@ -236,7 +631,13 @@ class MainWindow():
         self.clear_button.connect("clicked", self.on_clear_button)
         self.close_button.connect("clicked", self.on_close_button)
         self.rename_button.connect("clicked", self.on_rename_button)
+        self.progress_box = self.builder.get_object("progress_box")
+        self.progress_bar = self.builder.get_object("progress_bar")
+        self.progress_cancel_button = self.builder.get_object("progress_cancel_button")
+        self.progress_cancel_button.connect("clicked", self.on_progress_cancel_button)
         self.window.connect("key-press-event",self.on_key_press_event)
+        self.window.connect("delete-event", self.on_delete_event)
+        self.window.connect("destroy", self.on_window_destroyed)
 
         # DND
         self.dnd_box = self.builder.get_object("dnd")  # DND target, topmost window child
@@ -256,6 +657,19 @@ class MainWindow():
         self.window.add_accel_group(accel_group)
         menu = self.builder.get_object("main_menu")
         item = Gtk.ImageMenuItem()
+        item.set_image(Gtk.Image.new_from_icon_name("xsi-folder-symbolic", Gtk.IconSize.MENU))
+        item.set_label(_("Add Folder Contents..."))
+        item.connect("activate", self.on_add_folder_contents)
+        key, mod = Gtk.accelerator_parse("<Control><Shift>N")
+        item.add_accelerator("activate", accel_group, key, mod, Gtk.AccelFlags.VISIBLE)
+        menu.append(item)
+        item = Gtk.ImageMenuItem()
+        item.set_image(Gtk.Image.new_from_icon_name("xsi-edit-undo-symbolic", Gtk.IconSize.MENU))
+        item.set_label(_("Undo Last Rename"))
+        item.connect("activate", self.on_undo_last_rename)
+        menu.append(item)
+        menu.append(Gtk.SeparatorMenuItem())
+        item = Gtk.ImageMenuItem()
         item.set_image(Gtk.Image.new_from_icon_name("xsi-help-about-symbolic", Gtk.IconSize.MENU))
         item.set_label(_("About"))
         item.connect("activate", self.open_about)
@@ -290,13 +704,19 @@ class MainWindow():
         column.set_expand(True)
         self.treeview.append_column(column)
 
-        column = Gtk.TreeViewColumn(_("New name"), Gtk.CellRendererText(), text=COL_NEW_NAME)
+        renderer_text = Gtk.CellRendererText()
+        column = Gtk.TreeViewColumn(_("New name"), renderer_text, text=COL_NEW_NAME)
+        column.set_cell_data_func(renderer_text, self.data_func_new_name)
         column.set_expand(True)
         self.treeview.append_column(column)
 
         self.treeview.show()
-        self.model = Gtk.TreeStore(Gio.Icon, str, str, object, GdkPixbuf.Pixbuf) # icon, name, new_name, file, pixbuf
+        # Rows are never nested, so a flat list is all we need
+        self.model = Gtk.ListStore(Gio.Icon, str, str, object) # icon, name, new_name, file
         self.model.set_sort_column_id(COL_NAME, Gtk.SortType.ASCENDING)
+        # Sorting moves rows around, cached previews are in row order
+        self.model.connect("sort-column-changed", self.on_rows_reordered)
+        self.model.connect("rows-reordered", self.on_rows_reordered)
         self.treeview.set_model(self.model)
         self.treeview.get_selection().set_mode(Gtk.SelectionMode.MULTIPLE)
         self.treeview.get_selection().connect("changed", self.on_files_selected)
@@ -309,6 +729,13 @@ class MainWindow():
         self.combo_scope.set_active_id(self.settings.get_string(MRU_SCOPE))
         self.combo_scope.connect("changed", self.on_scope_changed)
 
+        # Pipeline of operations
+        self.add_step_button = self.builder.get_object("add_step_button")
+        self.add_step_button.connect("clicked", self.on_add_step_button)
+        self.clear_steps_button = self.builder.get_object("clear_steps_button")
+        self.clear_steps_button.connect("clicked", self.on_clear_steps_button)
+        self.steps_label = self.builder.get_object("steps_label")
+
         self.stack = self.builder.get_object("stack")
         self.infobar = self.builder.get_object("infobar")
         self.error_label = self.builder.get_object("error_label")
@@ -399,11 +826,13 @@ class MainWindow():
         self.radio_accents.connect("toggled", self.on_widget_change)
 
         # Tooltips
-        variables_tooltip = _("Use %n, %0n, %00n, %000n, etc. to enumerate.")
+        variables_tooltip = _("Use %n, %0n, %00n, %000n, etc. to enumerate.") + "\n" + \
+            _("Use %mtime for the modification date, %exif for the date a photo was taken and %size for the size in bytes. Dates can be formatted, e.g. %exif{%Y-%m-%d_%H%M%S}.")
         self.replace_entry.set_tooltip_text(variables_tooltip)
         self.insert_entry.set_tooltip_text(variables_tooltip)
 
-        self.load_files(sys.argv[1:], initial_load=True)
+        GLib.idle_add(self.check_interrupted_rename)
+        self.load_files(files or [], initial_load=True)
 
     def on_drag_data_received(self, widget, context, x, y, data, info, _time, user_data=None):
         if data:
@@ -420,17 +849,100 @@ class MainWindow():
         Gtk.drag_finish(context, True, False, _time)
 
     def data_func_icon(self, column, cell, model, iter_, *args):
-        pixbuf = model.get_value(iter_, COL_PIXBUF)
+        file_obj = model.get_value(iter_, COL_FILE)
         icon = model.get_value(iter_, COL_ICON)
+        surface = None
+
+        # This only runs for rows being drawn, so thumbnails get
+        # decoded on demand, for visible rows only.
+        if file_obj is not None and file_obj.thumb_path is not None:
+            key = (file_obj.thumb_path, self.window.get_scale_factor())
+            surface = self.thumbnail_cache.lookup(key)
+            if surface is None:
+                self.request_thumbnail(key, file_obj.uri)
 
-        if pixbuf is not None:
-            surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, self.window.get_scale_factor())
+        if surface is not None:
             cell.set_property("gicon", None)
             cell.set_property("surface", surface)
         else:
             cell.set_property("surface", None)
             cell.set_property("gicon", icon)
 
+    def request_thumbnail(self, key, uri):
+        if key in self.thumbnail_requests:
+            return
+        self.thumbnail_requests.add(key)
+        self.thumbnail_queue.append((key, uri))
+        self.process_thumbnail_queue()
+
+    def process_thumbnail_queue(self):
+        while self.thumbnail_pending < THUMBNAIL_MAX_PENDING and len(self.thumbnail_queue) > 0:
+            # Most recently requested rows first
+            key, uri = self.thumbnail_queue.pop()
+            if not self.is_row_visible(uri):
+                # Scrolled away, it'll be requested again when drawn
+                self.thumbnail_requests.discard(key)
+                continue
+            self.thumbnail_pending += 1
+            thumb_file = Gio.File.new_for_path(key[0])
+            token = tracing.begin("thumbnail")
+            thumb_file.read_async(GLib.PRIORITY_LOW, None, self.on_thumbnail_opened, (key, uri, token))
+
+    def is_row_visible(self, uri):
+        iter = self.uris.get(uri)
+        if iter is None:
+            return False
+        visible_range = self.treeview.get_visible_range()
+        if visible_range is None:
+            return False
+        start, end = visible_range
+        path = self.model.get_path(iter)
+        return start.compare(path) <= 0 and path.compare(end) <= 0
+
+    def on_thumbnail_opened(self, thumb_file, result, data):
+        key, uri, token = data
+        try:
+            stream = thumb_file.read_finish(result)
+            size = 22 * key[1]
+            # Decoding happens in a worker thread
+            GdkPixbuf.Pixbuf.new_from_stream_at_scale_async(stream, size, size, True, None,
+                                                            self.on_thumbnail_decoded, (key, uri, token, stream))
+        except GLib.Error as e:
+            # Leave the key in thumbnail_requests so we don't retry
+            print(e.message)
+            tracing.end(token, error=True)
+            self.thumbnail_pending -= 1
+            self.process_thumbnail_queue()
+
+    def on_thumbnail_decoded(self, source, result, data):
+        key, uri, token, stream = data
+        tracing.end(token)
+        self.thumbnail_pending -= 1
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_stream_finish(result)
+            surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, key[1])
+            self.thumbnail_cache.insert(key, surface, pixbuf.get_byte_length())
+            self.thumbnail_requests.discard(key)
+            iter = self.uris.get(uri)
+            if iter is not None:
+                self.model.row_changed(self.model.get_path(iter), iter)
+        except GLib.Error as e:
+            print(e.message)
+        stream.close(None)
+        self.process_thumbnail_queue()
+
+    def data_func_new_name(self, column, cell, model, iter_, *args):
+        # Highlight every row involved in a name collision
+        file_obj = model.get_value(iter_, COL_FILE)
+        if file_obj is not None and file_obj.uri in self.collision_uris:
+            found, color = self.treeview.get_style_context().lookup_color("error_color")
+            if not found:
+                color = Gdk.RGBA()
+                color.parse("red")
+            cell.set_property("foreground-rgba", color)
+        else:
+            cell.set_property("foreground-set", False)
+
     def open_about(self, widget):
         dlg = Gtk.AboutDialog()
         dlg.set_transient_for(self.window)
@@ -455,6 +967,9 @@ class MainWindow():
         dlg.show()
 
     def on_menu_quit(self, widget):
+        if self.application.rename_executor is not None:
+            self.confirm_close(self.application.quit)
+            return
         self.application.quit()
 
     def on_files_selected(self, selection):
@@ -468,8 +983,21 @@ class MainWindow():
                 self.on_add_button(self.add_button)
             elif event.keyval == Gdk.KEY_d:
                 self.on_remove_button(self.remove_button)
+        elif event.keyval == Gdk.KEY_F5:
+            self.refresh()
+
+    def refresh(self):
+        # Forget what we know about the directories and check again
+        self.directory_cache.invalidate()
+        self.preview_changes()
+
+    def on_directory_listed(self):
+        # Check the new names against the files found
+        self.preview_changes(debounce=True)
 
     def on_remove_button(self, widget):
+        if self.application.rename_executor is not None:
+            return
         iters = []
         model, paths = self.treeview.get_selection().get_selected_rows()
         for path in paths:
@@ -478,12 +1006,15 @@ class MainWindow():
             iters.append(self.model.get_iter(path))
         for iter in iters:
             file_uri = self.model.get_value(iter, COL_FILE).uri
-            self.uris.remove(file_uri)
+            del self.uris[file_uri]
             self.model.remove(iter)
+        self.rows_changed()
         self.treeview.columns_autosize()
         self.preview_changes()
 
     def on_add_button(self, widget):
+        if self.application.rename_executor is not None:
+            return
         dialog = FolderFileChooserDialog(_("Add files"), self.window, self.last_chooser_location)
 
         def update_last_location(dialog, response_id, data=None):
@@ -495,19 +1026,75 @@ class MainWindow():
 
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            for uri in dialog.get_uris():
-                self.add_file(uri)
-        self.preview_changes()
+            self.queue_files(dialog.get_uris())
+        dialog.destroy()
+
+    def on_add_folder_contents(self, widget):
+        if self.application.rename_executor is not None:
+            return
+        dialog = FolderImportDialog(_("Add folder contents"), self.window, self.last_chooser_location)
+
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            self.last_chooser_location = dialog.get_current_folder_file()
+            self.scan_folders(dialog.get_files(), dialog.get_options())
         dialog.destroy()
 
     def on_clear_button(self, widget):
+        if self.application.rename_executor is not None:
+            return
+        self.cancel_loading()
+        self.cancel_preview()
+        # Files loaded but not added yet would come back after the clear
+        self.load_batch = []
+        if self.load_flush_id is not None:
+            GLib.source_remove(self.load_flush_id)
+            self.load_flush_id = None
+        self.load_total = 0
+        self.load_done = 0
         self.model.clear()
         self.uris.clear()
+        self.rows_changed()
+        self.preview_changes()
+
+    def on_window_destroyed(self, window):
+        # Don't leave the worker processes behind, in service mode we keep running
+        self.cancel_preview()
+        if self.preview_pool is not None:
+            self.preview_pool.close()
 
     def on_close_button(self, widget):
-        self.application.quit()
+        # The application quits (or lingers, in service mode) once the window is gone
+        self.window.close()
 
-    def report_os_error(self, file_obj, new_path, error):
+    def on_delete_event(self, window, event):
+        # Going now would stop the batch half way without saying so, and
+        # leave its journal looking interrupted
+        if self.application.rename_executor is None:
+            return False
+        self.confirm_close(self.window.destroy)
+        return True
+
+    def confirm_close(self, close):
+        dialog = Gtk.MessageDialog(transient_for=self.window, modal=True,
+                                   message_type=Gtk.MessageType.QUESTION, buttons=Gtk.ButtonsType.NONE,
+                                   text=_("Files are still being renamed."))
+        dialog.format_secondary_text(_("Stop renaming? The files renamed so far keep their new names."))
+        dialog.add_button(_("Continue Renaming"), Gtk.ResponseType.CANCEL)
+        dialog.add_button(_("Stop and Close"), Gtk.ResponseType.CLOSE)
+        response = dialog.run()
+        dialog.destroy()
+        if response != Gtk.ResponseType.CLOSE:
+            return
+        if self.application.rename_executor is None:
+            # It finished in the meantime
+            close()
+            return
+        # Close once the renames in flight are done, see on_rename_finished()
+        self.close_after_rename = close
+        self.application.rename_executor.cancel()
+
+    def get_rename_error_message(self, file_obj, error):
         message = ""
         # Gio's error prints the too-long filename as part of its
         # error message, which looks really bad. Maybe we'll need
@@ -522,122 +1109,424 @@ class MainWindow():
         else:
             message = _("Unable to rename '%s': %s") \
                 % (file_obj.get_path_or_uri_for_display(), error.message)
+        return message
 
-        self.error_label.set_text(message)
+    def report_os_error(self, file_obj, new_path, error):
+        self.error_label.set_text(self.get_rename_error_message(file_obj, error))
         self.infobar.show()
 
     def on_rename_button(self, widget):
-        iters = []
+        # Swaps and cycles are fine, the scheduler orders the renames
+        # and goes through temporary names where needed.
+        renames = []
         iter = self.model.get_iter_first()
         while iter != None:
-            iters.append(iter)
-            iter = self.model.iter_next(iter)
-        # We're modifying the model here, so we iterate
-        # through our own list of iters rather than the model
-        # itself
-        rename_list = []
-        for iter in iters:
             try:
                 file_obj = self.model.get_value(iter, COL_FILE)
                 name = self.model.get_value(iter, COL_NAME)
                 new_name = self.model.get_value(iter, COL_NEW_NAME)
-                rename_list.append((iter, file_obj, name, new_name))
+                if new_name != name:
+                    renames.append((file_obj.uri, file_obj.get_pending_uri(new_name), file_obj.is_a_dir(), iter))
             except Exception as e:
                 print(e)
+            iter = self.model.iter_next(iter)
 
-        rename_list = self.sort_list_by_depth(rename_list)
-
-        # for i in rename_list:
-        #     print(i[0].gfile.get_uri())
-
-        for tup in rename_list:
-                iter, file_obj, name, new_name = tup
-                if new_name != name:
-                    try:
-                        old_uri = file_obj.uri
-                        # print("Renaming %s --> %s" % (file_obj.get_path_or_uri_for_display(), new_name))
-                        if file_obj.rename(new_name):
-                            self.uris.remove(old_uri)
-                            self.uris.append(file_obj.uri)
-                            self.model.set_value(iter, COL_NAME, new_name)
-                    except GLib.Error as e:
-                        self.report_os_error(file_obj, new_name, e)
-                        break
+        self.run_renames(scheduler.schedule(renames))
 
+    def run_renames(self, waves, undo=False):
+        # waves: lists of scheduler.RenameStep
+        self.cancel_preview()
+        self.infobar.hide()
         self.rename_button.set_sensitive(False)
-
-    def sort_list_by_depth(self, rename_list):
-        # Rename files first, followed by directories from deep to shallow.
-        def file_cmp(tup_a, tup_b):
-            fo_a = tup_a[1]
-            fo_b = tup_b[1]
-
-            if fo_a.is_a_dir() and (not fo_b.is_a_dir()):
-                return 1
-            elif fo_b.is_a_dir() and (not fo_a.is_a_dir()):
-                return -1
-
-            if fo_a.gfile.has_prefix(fo_b.gfile):
-                return -1
-            elif fo_b.gfile.has_prefix(fo_a.gfile):
-                return 1
-
-            return GLib.utf8_collate(fo_a.uri, fo_b.uri)
-
-        rename_list.sort(key=lambda tup: tup[1].gfile.get_uri_scheme())
-        rename_list.sort(key=functools.cmp_to_key(file_cmp))
-        return rename_list
+        self.add_button.set_sensitive(False)
+        self.remove_button.set_sensitive(False)
+        self.clear_button.set_sensitive(False)
+        import renamer
+        # Keeps a service running until the batch is complete
+        self.application.hold()
+        executor = renamer.RenameExecutor(renamer.make_jobs(waves), self.on_rename_progress,
+                                          self.on_file_renamed, self.on_rename_finished,
+                                          journal=self.application.get_journal(), undo=undo)
+        self.application.rename_executor = executor
+        self.on_rename_progress(0, executor.total)
+        self.progress_box.show()
+        self.rename_trace = tracing.begin("rename_files", renames=executor.total, undo=undo)
+        executor.start()
+
+    def run_journal_renames(self, uri_waves, undo):
+        # Rename (old uri, new uri) pairs from the journal, updating any loaded rows
+        waves = [[scheduler.RenameStep(old_uri, new_uri, self.uris.get(old_uri)) for old_uri, new_uri in uri_wave]
+                 for uri_wave in uri_waves]
+        self.run_renames(waves, undo)
+
+    def on_undo_last_rename(self, widget):
+        if self.application.rename_executor is not None:
+            return
+        batch = self.application.get_journal().load()
+        if batch is None or not batch.can_undo():
+            self.error_label.set_text(_("There is nothing to undo."))
+            self.infobar.show()
+            return
+        self.run_journal_renames(batch.get_undo_waves(batch.done), undo=True)
+
+    def check_interrupted_rename(self):
+        # Offer to roll back or finish a batch that didn't complete, e.g.
+        # because we crashed or were killed in the middle of it.
+        if self.application.rename_executor is not None:
+            # Our own batch, its journal is still being written
+            return GLib.SOURCE_REMOVE
+        journal = self.application.get_journal()
+        if not journal.may_be_interrupted():
+            return GLib.SOURCE_REMOVE
+        batch = journal.load()
+        if batch is None or not batch.is_interrupted():
+            return GLib.SOURCE_REMOVE
+
+        bar = Gtk.InfoBar(message_type=Gtk.MessageType.WARNING, show_close_button=True)
+        label = Gtk.Label(label=_("The last rename operation was interrupted before it completed."),
+                          wrap=True, xalign=0)
+        bar.get_content_area().add(label)
+        bar.add_button(_("Roll Back"), RESPONSE_ROLL_BACK)
+        bar.add_button(_("Finish"), RESPONSE_FINISH)
+        bar.connect("response", self.on_recovery_response, batch)
+        box = self.infobar.get_parent()
+        box.pack_start(bar, False, True, 0)
+        box.reorder_child(bar, 0)
+        bar.show_all()
+        return GLib.SOURCE_REMOVE
+
+    def on_recovery_response(self, bar, response_id, batch):
+        if response_id in (RESPONSE_ROLL_BACK, RESPONSE_FINISH):
+            if self.application.rename_executor is not None:
+                return
+            done = batch.recover(lambda uri: Gio.File.new_for_uri(uri).query_exists(None))
+            if response_id == RESPONSE_ROLL_BACK:
+                self.run_journal_renames(batch.get_undo_waves(done), undo=True)
+            else:
+                self.run_journal_renames(batch.get_remaining_waves(done), undo=False)
+        bar.destroy()
+
+    def on_rename_progress(self, done, total):
+        if total > 0:
+            self.progress_bar.set_fraction(done / total)
+        self.progress_bar.set_text(_("Renaming files... (%d/%d)") % (done, total))
+
+    def on_file_renamed(self, job):
+        self.directory_cache.rename(job.gfile.get_uri(), job.new_gfile.get_uri())
+        iter = job.data
+        if iter is None:
+            # Not a loaded file (undo or recovery)
+            return
+        file_obj = self.model.get_value(iter, COL_FILE)
+        old_uri = file_obj.uri
+        file_obj.set_renamed(job.new_gfile, job.new_name)
+        # With cycles, another row may already have taken over the old uri
+        old_iter = self.uris.get(old_uri)
+        if old_iter is not None and self.model.get_value(old_iter, COL_FILE) is file_obj:
+            del self.uris[old_uri]
+        self.uris[file_obj.uri] = iter
+        self.model.set_value(iter, COL_NAME, job.new_name)
+        self.rows_changed()
+
+    def on_rename_finished(self, executor):
+        tracing.end(self.rename_trace, errors=len(executor.errors), cancelled=executor.is_cancelled())
+        self.application.rename_executor = None
+        self.application.release()
+        if self.close_after_rename is not None:
+            self.close_after_rename()
+            return
+        self.progress_box.hide()
+        self.directory_cache.invalidate_writable()
+        self.add_button.set_sensitive(True)
+        self.clear_button.set_sensitive(True)
+        self.on_files_selected(self.treeview.get_selection())
+
+        # Report every failure at once rather than stopping at the first one
+        errors = executor.errors
+        if len(errors) > 0:
+            job = errors[0]
+            if job.data is not None:
+                file_obj = self.model.get_value(job.data, COL_FILE)
+            else:
+                file_obj = FileObject(job.gfile)
+        if len(errors) == 1:
+            self.report_os_error(file_obj, job.new_name, job.error)
+        elif len(errors) > 1:
+            message = gettext.ngettext("%d file could not be renamed.",
+                                       "%d files could not be renamed.",
+                                       len(errors)) % len(errors)
+            message += " " + self.get_rename_error_message(file_obj, job.error)
+            self.error_label.set_text(message)
+            self.infobar.show()
 
     def load_files(self, uris, initial_load=False):
         # Clear treeview and selection
         if len(uris) > 0:
             if initial_load:
                 self.builder.get_object("file_toolbox").hide()
-            for path in uris:
-                self.add_file(path)
+            self.queue_files(uris)
         else:
             self.builder.get_object("headerbar").set_title(_("File Renamer"))
             self.builder.get_object("headerbar").set_subtitle(_("Rename files and directories"))
 
         self.preview_changes()
 
+    # Files are loaded asynchronously: at most LOAD_MAX_PENDING query_info
+    # calls are in flight, and the results are added to the model in
+    # batches from an idle callback, so rows show up while the rest load.
+    def queue_files(self, paths_or_uris):
+        if len(paths_or_uris) == 0:
+            return
+        self.start_loading()
+        self.load_queue.extend(paths_or_uris)
+        self.load_total += len(paths_or_uris)
+        self.update_load_progress()
+        self.fill_load_pipeline()
+
+    def scan_folders(self, folders, options):
+        # Add the contents of directory trees. The infos come straight from
+        # the enumeration so there's no need to query each file again.
+        if len(folders) == 0:
+            return
+        import scanner
+        self.start_loading()
+        folder_scanner = scanner.FolderScanner(SCAN_ATTRIBUTES, options, self.load_cancellable,
+                                               self.on_scan_found, self.on_scan_done)
+        self.load_scanners.add(folder_scanner)
+        for folder in folders:
+            folder_scanner.scan(folder)
+        self.update_load_progress()
+
+    def read_file_list(self, stream, null_separated):
+        # Add the files listed in a stream, loading them as the list is read
+        self.start_loading()
+        reader = pathlist.PathListReader(stream, null_separated, self.load_cancellable,
+                                         self.on_list_found, self.on_list_done)
+        self.load_readers.add(reader)
+        reader.read()
+        self.update_load_progress()
+
+    def on_list_found(self, paths):
+        self.queue_files(paths)
+        self.read_file_lists()
+
+    def on_list_done(self, reader):
+        self.load_readers.discard(reader)
+        self.check_loading_finished()
+
+    def read_file_lists(self):
+        # Read more of the lists only while few enough files are queued
+        if len(self.load_queue) < LOAD_MAX_QUEUED:
+            for reader in list(self.load_readers):
+                reader.read()
+
+    def start_loading(self):
+        if self.load_cancellable is None:
+            self.load_total = 0
+            self.load_done = 0
+            self.load_trace = tracing.begin("load_files")
+        if self.load_cancellable is None or self.load_cancellable.is_cancelled():
+            self.load_cancellable = Gio.Cancellable()
+        self.progress_box.show()
+
+    def on_scan_found(self, found):
+        for gfile, info in found:
+            self.load_batch.append(FileObject(gfile, info))
+        self.load_total += len(found)
+        self.load_done += len(found)
+        if self.load_flush_id is None:
+            self.load_flush_id = GLib.idle_add(self.flush_loaded_files)
+
+    def on_scan_done(self, folder_scanner):
+        self.load_scanners.discard(folder_scanner)
+        self.check_loading_finished()
+
+    def fill_load_pipeline(self):
+        while self.load_pending < LOAD_MAX_PENDING and len(self.load_queue) > 0:
+            path_or_uri = self.load_queue.popleft()
+            gfile = FileObject.create_gfile(path_or_uri)
+            self.load_pending += 1
+            token = tracing.begin("query_info")
+            gfile.query_info_async(FILE_ATTRIBUTES, Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_DEFAULT,
+                                   self.load_cancellable, self.on_file_info_loaded, (self.load_cancellable, token))
+        self.read_file_lists()
+
+    def on_file_info_loaded(self, gfile, result, data):
+        cancellable, token = data
+        tracing.end(token)
+        self.load_pending -= 1
+        if cancellable.is_cancelled():
+            self.check_loading_finished()
+            return
+
+        try:
+            info = gfile.query_info_finish(result)
+            self.load_batch.append(FileObject(gfile, info))
+            if self.load_flush_id is None:
+                self.load_flush_id = GLib.idle_add(self.flush_loaded_files)
+        except GLib.Error as e:
+            if e.code == Gio.IOErrorEnum.NOT_FOUND:
+                print("file %s does not exist" % gfile.get_uri())
+            else:
+                print(e.message)
+            tracing.count("load_errors")
+
+        self.load_done += 1
+        self.fill_load_pipeline()
+        self.check_loading_finished()
+
+    def flush_loaded_files(self):
+        self.load_flush_id = None
+        batch = self.load_batch
+        self.load_batch = []
+        with tracing.span("add_rows", rows=len(batch)):
+            if len(batch) >= MODEL_DETACH_ROWS or self.load_total >= MODEL_DETACH_ROWS:
+                self.detach_model()
+            for file_obj in batch:
+                self.add_file_object(file_obj)
+            if self.load_cancellable is None:
+                # The load is over
+                self.attach_model()
+        tracing.count("rows_loaded", len(batch))
+        self.update_load_progress()
+        if self.load_cancellable is not None:
+            self.preview_changes(debounce=True)
+        return GLib.SOURCE_REMOVE
+
+    def detach_model(self):
+        # For large loads, detach the model from the view and stop sorting
+        # until the load is over, then sort everything once.
+        if self.load_detached_sort is not None:
+            return
+        self.load_detached_sort = self.model.get_sort_column_id()
+        self.treeview.set_model(None)
+        self.model.set_sort_column_id(Gtk.TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID, Gtk.SortType.ASCENDING)
+
+    def attach_model(self):
+        if self.load_detached_sort is None:
+            return
+        sort_column_id, sort_order = self.load_detached_sort
+        self.load_detached_sort = None
+        if sort_column_id is not None:
+            self.model.set_sort_column_id(sort_column_id, sort_order)
+        self.treeview.set_model(self.model)
+
+    def check_loading_finished(self):
+        if self.load_pending > 0 or len(self.load_scanners) > 0 or len(self.load_readers) > 0:
+            return
+        if self.load_flush_id is not None:
+            GLib.source_remove(self.load_flush_id)
+        self.load_cancellable = None
+        self.load_queue.clear()
+        self.flush_loaded_files()
+        tracing.end(self.load_trace, files=self.load_done)
+        self.load_trace = None
+        if self.application.rename_executor is None:
+            self.progress_box.hide()
+        self.preview_changes()
+
+    def cancel_loading(self):
+        if self.load_cancellable is not None:
+            self.load_cancellable.cancel()
+            self.load_queue.clear()
+            # Lets idle readers notice the cancellation and finish
+            self.read_file_lists()
+
+    def update_load_progress(self):
+        if self.application.rename_executor is not None:
+            # The progress bar is showing the renames
+            return
+        if len(self.load_scanners) > 0:
+            # We don't know how many files there are until the scan ends
+            self.progress_bar.pulse()
+            self.progress_bar.set_text(_("Scanning folders... (%d files found)") % self.load_total)
+            return
+        if self.load_total > 0:
+            self.progress_bar.set_fraction(self.load_done / self.load_total)
+        self.progress_bar.set_text(_("Loading files... (%d/%d)") % (self.load_done, self.load_total))
+
+    def on_progress_cancel_button(self, widget):
+        self.cancel_loading()
+        if self.application.rename_executor is not None:
+            self.application.rename_executor.cancel()
+
     def add_file(self, uri_or_path):
-        file_obj = FileObject(uri_or_path, self.window.get_scale_factor())
+        self.add_file_object(FileObject(uri_or_path))
 
+    def add_file_object(self, file_obj):
         if file_obj.is_valid:
             if file_obj.uri in self.uris:
                 print("%s is already loaded, ignoring" % file_obj.uri)
                 return
-            self.uris.append(file_obj.uri)
-            iter = self.model.insert_before(None, None)
-            self.model.set_value(iter, COL_ICON, file_obj.icon)
-            self.model.set_value(iter, COL_NAME, file_obj.name)
-            self.model.set_value(iter, COL_NEW_NAME, file_obj.name)
-            self.model.set_value(iter, COL_FILE, file_obj)
-            self.model.set_value(iter, COL_PIXBUF, file_obj.pixbuf)
+            # Insert the row with all its values at once: a single row-inserted
+            # signal rather than one row-changed (and re-sort) per column.
+            iter = self.model.insert_with_valuesv(-1, [COL_ICON, COL_NAME, COL_NEW_NAME, COL_FILE],
+                                                  [file_obj.icon, file_obj.name, file_obj.name, file_obj])
+            self.uris[file_obj.uri] = iter
+            self.rows_changed()
+
+    def rows_changed(self):
+        # Rows were added, removed, renamed or their metadata changed:
+        # the cached previews don't apply anymore.
+        self.rows_version += 1
+        self.preview_cache.clear()
+
+    def on_rows_reordered(self, model, *args):
+        self.rows_changed()
+        self.preview_changes(debounce=True)
 
     def on_operation_changed(self, widget):
         operation_id = widget.get_active_id()
         if operation_id == "replace":
             self.stack.set_visible_child_name("replace_page")
-            self.operation_function = self.replace_text
+            self.operation = "replace"
         elif operation_id == "remove":
             self.stack.set_visible_child_name("remove_page")
-            self.operation_function = self.remove_text
+            self.operation = "remove"
         elif operation_id == "insert":
             self.stack.set_visible_child_name("insert_page")
-            self.operation_function = self.insert_text
+            self.operation = "insert"
         elif operation_id == "case":
             self.stack.set_visible_child_name("case_page")
-            self.operation_function = self.change_case
+            self.operation = "case"
 
         self.settings.set_string(MRU_OPERATION, operation_id)
+        self.plan = None
         self.preview_changes()
 
     def on_scope_changed(self, widget):
         self.scope = widget.get_active_id()
 
         self.settings.set_string(MRU_SCOPE, self.scope)
+        self.plan = None
+        self.preview_changes()
+
+    def on_add_step_button(self, widget):
+        # Keep the current operation as a step, and reset its widgets so it
+        # can be used for the next step. Case changes can't be reset but
+        # applying them twice makes no difference.
+        self.steps.append((self.combo_operation.get_active_text(), self.get_step_params()))
+        if self.operation == "replace":
+            self.find_entry.set_text("")
+        elif self.operation == "remove":
+            self.remove_from_spin.set_value(1)
+            self.remove_to_spin.set_value(1)
+        elif self.operation == "insert":
+            self.insert_entry.set_text("")
+        self.update_steps()
+
+    def on_clear_steps_button(self, widget):
+        self.steps = []
+        self.update_steps()
+
+    def update_steps(self):
+        labels = [label for label, params in self.steps]
+        if len(labels) > 0:
+            self.steps_label.set_text(" › ".join(labels) + " ›")
+        else:
+            self.steps_label.set_text("")
+        self.clear_steps_button.set_sensitive(len(self.steps) > 0)
+        self.plan = None
         self.preview_changes()
 
     def on_widget_change(self, widget):
@@ -645,167 +1534,357 @@ class MainWindow():
             self.find_entry.set_placeholder_text("Enter a regular expression; example: .+")
         else:
             self.find_entry.set_placeholder_text("Enter a search string; wildcards ? and * are supported.")
-        self.preview_changes()
-
-    def preview_changes(self):
+        self.plan = None
+        self.preview_changes(debounce=True)
+        if self.replace_regex_check.get_active():
+            # Regular expressions run in the workers, get them started
+            self.get_preview_pool().start()
+
+    def preview_changes(self, debounce=False):
+        # The preview runs as an idle job, in time-bounded chunks, so the window
+        # stays responsive with large selections. Any new request cancels the
+        # job in progress and starts over. Rapid input (typing, spinning) is
+        # debounced so we don't restart on every keystroke.
+        self.cancel_preview()
+        if self.application.rename_executor is not None:
+            # Rows are being renamed, leave the new names alone
+            return
+        self.rename_button.set_sensitive(False)
+        if debounce:
+            self.preview_source_id = GLib.timeout_add(PREVIEW_DEBOUNCE_MS, self.start_preview)
+        else:
+            self.preview_source_id = GLib.idle_add(self.start_preview)
+
+    def cancel_preview(self):
+        # The workers drop a pool request still running, including the
+        # chunks they're working on.
+        if self.preview_pool_request is not None:
+            self.preview_pool.cancel()
+            self.preview_pool_request = None
+        if self.preview_source_id is not None:
+            GLib.source_remove(self.preview_source_id)
+            self.preview_source_id = None
+        if self.preview_job is not None:
+            self.preview_job.close()
+            self.preview_job = None
+            tracing.end(self.preview_trace, cancelled=True)
+
+    def start_preview(self):
+        self.preview_trace = tracing.begin("preview_changes")
+        self.preview_job = self.compute_preview()
+        self.preview_source_id = GLib.idle_add(self.run_preview_chunk)
+        return GLib.SOURCE_REMOVE
+
+    def run_preview_chunk(self):
+        deadline = GLib.get_monotonic_time() + PREVIEW_CHUNK_USEC
+        try:
+            while GLib.get_monotonic_time() < deadline:
+                if next(self.preview_job) is PREVIEW_WAIT:
+                    # Resumed by on_pool_preview_done
+                    self.preview_source_id = None
+                    return GLib.SOURCE_REMOVE
+        except StopIteration:
+            self.preview_job = None
+            self.preview_source_id = None
+            tracing.end(self.preview_trace, cancelled=False)
+            return GLib.SOURCE_REMOVE
+        return GLib.SOURCE_CONTINUE
+
+    def set_scope_all(self):
+        # Directories are renamed as a whole, and so are the saved steps
+        self.steps = [(label, engine.RenameParams(params.operation, SCOPE_ALL)) for label, params in self.steps]
+        self.builder.get_object("combo_scope").set_active_id(SCOPE_ALL)
+        self.update_steps()
+        return False
+
+    def compute_preview(self):
+        # Generator doing the actual preview, it yields after every row
         self.infobar.hide()
 
-        # Adjust scope first if necessary
+        # Read all the rows in one pass
+        rows = [] # (iter, file_obj, name, displayed new name)
         any_dirs = False
         iter = self.model.get_iter_first()
         while iter != None:
-            try:
-                file_obj = self.model.get_value(iter, COL_FILE)
-                any_dirs = file_obj.is_a_dir() or any_dirs
-                iter = self.model.iter_next(iter)
-            except:
-                pass
+            file_obj, name, new_name = self.model.get(iter, COL_FILE, COL_NAME, COL_NEW_NAME)
+            rows.append((iter, file_obj, name, new_name))
+            any_dirs = any_dirs or file_obj.is_a_dir()
+            iter = self.model.iter_next(iter)
+            yield
 
+        # Adjust scope first if necessary
         combo = self.builder.get_object("combo_scope")
 
         if any_dirs:
-            # on_scope_changed will update self.scope
-            combo.set_active_id(SCOPE_ALL)
             combo.set_sensitive(False)
+            if combo.get_active_id() != SCOPE_ALL or \
+               any(params.scope != SCOPE_ALL for label, params in self.steps):
+                # set_scope_all will restart the preview, which cancels this
+                # job, and that can't be done while it's running.
+                GLib.idle_add(self.set_scope_all)
+                return
         else:
             combo.set_sensitive(True)
 
-        self.renamed_uris = []
+        self.pending_uris = {}
+        self.collision_uris = set()
         any_changes = False
+        any_errors = False
 
-        iter = self.model.get_iter_first()
+        if len(rows) == 0:
+            # Nothing loaded yet (the operation widgets may not even exist)
+            return
+
+        # Only rows whose new name differs from the one displayed are
+        # updated, so unchanged rows don't emit row-changed.
+        plan = self.get_rename_plan()
+        # Going back to recent settings reuses their names
+        cache_key = (self.rows_version, plan.params.key())
+        cached_names = self.preview_cache.lookup(cache_key)
+        computed_names = cached_names
+        new_names = []
+        use_metadata = len(plan.fields) > 0
+
+        # Cheap operations don't need the workers, or even the module
+        if computed_names is None and engine.is_expensive(plan.params) and \
+                self.get_preview_pool().should_use(plan.params, len(rows)):
+            # Spread large, expensive batches over all the cores and wait
+            # for the result without blocking the main loop. Regular
+            # expressions always go there, with a time budget.
+            import parallel
+            guarded = engine.uses_regex(plan.params)
+            names = [row[2] for row in rows]
+            file_metadata = [row[1].get_metadata() for row in rows] if use_metadata else None
+            request = object()
+            self.preview_pool_request = request
+            self.preview_pool_result = None
+            budget = REGEX_TIME_BUDGET_MS / 1000 if guarded else None
+            self.preview_pool.rename(plan.params, names, file_metadata,
+                                     lambda result, error: GLib.idle_add(self.on_pool_preview_done,
+                                                                         request, result, error),
+                                     budget)
+            yield PREVIEW_WAIT
+            computed_names, error = self.preview_pool_result
+            self.preview_pool_result = None
+
+            if computed_names is None and guarded:
+                # Too slow, or failed: don't risk running it here
+                if isinstance(error, parallel.RegexTimeout):
+                    tracing.count("regex_timeouts")
+                    message = _("The regular expression takes too long to run on these names. Please try a simpler one.")
+                else:
+                    tracing.count("regex_failures")
+                    message = _("The regular expression could not be applied to these names.")
+                for iter, file_obj, orig_name, displayed_name in rows:
+                    if orig_name != displayed_name:
+                        self.model.set_value(iter, COL_NEW_NAME, orig_name)
+                    yield
+                self.infobar.show()
+                self.error_label.set_text(message)
+                self.treeview.queue_draw()
+                return
+            # Otherwise computed locally below if the workers failed
+        use_exif = engine.FIELD_EXIF in plan.fields
+        exif_unread = [] # rows whose EXIF date we need to read
+        updated = 0
+        existing = [] # (file_obj, new_name) of the rows whose target is already on disk
+        listing = False # some directories are still being listed
         index = 1
-        while iter != None:
+        for iter, file_obj, orig_name, displayed_name in rows:
             try:
-                file_obj = self.model.get_value(iter, COL_FILE)
-                orig_name = self.model.get_value(iter, COL_NAME)
-                name, ext = os.path.splitext(orig_name)
-                if ext and ext.startswith('.'):
-                    ext = ext[1:]
-                if self.scope == SCOPE_NAME_ONLY:
-                    name = self.operation_function(index, name)
-                elif self.scope == SCOPE_EXTENSION_ONLY:
-                    ext = self.operation_function(index, ext)
+                if use_exif and not file_obj.exif_read and file_obj not in self.exif_reading:
+                    exif_unread.append(file_obj)
+                if computed_names is not None:
+                    new_name = computed_names[index - 1]
+                elif use_metadata:
+                    new_name = plan.apply(index, orig_name, file_obj.get_metadata())
                 else:
-                    full_name = self.operation_function(index, orig_name)
-                if self.scope == SCOPE_ALL:
-                    new_name = full_name
-                else:
-                    new_name = name + ('.' if ext else '') + ext
-
-                self.model.set_value(iter, COL_NEW_NAME, new_name)
+                    new_name = plan.apply(index, orig_name)
+                new_names.append(new_name)
+                if new_name != displayed_name:
+                    self.model.set_value(iter, COL_NEW_NAME, new_name)
+                    updated += 1
                 renamed_uri = file_obj.get_pending_uri(new_name)
-                if renamed_uri in self.renamed_uris:
-                    self.infobar.show()
-                    self.error_label.set_text(_("Name collision on '%s'.") % file_obj.get_path_or_uri_for_display())
-                    self.rename_button.set_sensitive(False)
-                elif not file_obj.parent_writable():
+                self.pending_uris.setdefault(renamed_uri, []).append(iter)
+                if new_name != orig_name and renamed_uri not in self.uris:
+                    # Loaded files in the way are handled above, check the others
+                    parent_uri, target_name = scheduler.split_uri(renamed_uri)
+                    names = self.directory_cache.get_names(parent_uri)
+                    if names is None:
+                        listing = True
+                    elif target_name in names:
+                        existing.append((file_obj, new_name))
+                        self.collision_uris.add(file_obj.uri)
+                if not file_obj.parent_writable(self.directory_cache):
                     self.infobar.show()
                     self.error_label.set_text(_("'%s' is not writeable.") % file_obj.get_parent_path_or_uri_for_display())
-                    self.rename_button.set_sensitive(False)
+                    any_errors = True
                 elif not file_obj.writable():
                     self.infobar.show()
                     self.error_label.set_text(_("'%s' is not writeable.") % file_obj.get_path_or_uri_for_display())
-                    self.rename_button.set_sensitive(False)
-                self.renamed_uris.append(renamed_uri)
+                    any_errors = True
                 any_changes = (new_name != orig_name) or any_changes
             except Exception as e:
                 print(e)
                 self.infobar.show()
                 self.error_label.set_text("'%s' %s." % (file_obj.get_path_or_uri_for_display(), str(e)))
-                self.model.set_value(iter, COL_NEW_NAME, orig_name)
-                self.renamed_uris.append(file_obj.uri)
-            iter = self.model.iter_next(iter)
+                if len(new_names) < index:
+                    new_names.append(orig_name)
+                if orig_name != displayed_name:
+                    self.model.set_value(iter, COL_NEW_NAME, orig_name)
+                self.pending_uris.setdefault(file_obj.uri, []).append(iter)
             index += 1
-        self.rename_button.set_sensitive(any_changes)
-
-    def replace_text(self, index, string):
-        case = self.replace_case_check.get_active()
-        regex = self.replace_regex_check.get_active()
-        find = self.find_entry.get_text()
-        if not find:  #ignore empty search string
-            return string
-        inc  = self.replace_inc_spin.get_value_as_int()
-        start= self.replace_start_spin.get_value_as_int()
-        replace = self.replace_entry.get_text()
-        replace = self.inject((index-1)*inc + start, replace)
-        try:
-            if regex:
-                if case:
-                    return re.sub(find, replace, string)
-                else:
-                    reg = re.compile(find, re.IGNORECASE)
-                    return reg.sub(replace, string)
-            else:
-                find = find.replace("*", "~~~REGSTAR~~~")
-                find = find.replace("?", "~~~REGQUES~~~")
-                find = re.escape(find)
-                find = find.replace(re.escape("~~~REGSTAR~~~"), ".+")
-                find = find.replace(re.escape("~~~REGQUES~~~"), ".")
-                if case:
-                    reg = re.compile(find)
-                    return reg.sub(replace, string)
-                else:
-                    reg = re.compile(find, re.IGNORECASE)
-                    return reg.sub(replace, string)
-        except re.error:
-            return string
-
-    def remove_text(self, index, string):
-        length = len(string)
+            yield
 
-        from_index = self.remove_from_spin.get_value_as_int() - 1
-        if self.remove_from_check.get_active():
-            from_index = max(length - from_index, 0)
-        else:
-            from_index = min(length, from_index)
+        tracing.count("rows_previewed", index - 1)
+        tracing.count("rows_updated", updated)
 
-        to_index = self.remove_to_spin.get_value_as_int() - 1
-        if self.remove_to_check.get_active():
-            to_index = max(length - to_index, 0)
+        if cached_names is None:
+            self.preview_cache.insert(cache_key, new_names,
+                                      sys.getsizeof(new_names) + sum(map(sys.getsizeof, new_names)))
         else:
-            to_index = min(length, to_index)
-
-        return string[0:min(from_index, to_index)] + string[max(from_index, to_index):]
-
-    def insert_text(self, index, string):
-        text = self.insert_entry.get_text()
-        inc  = self.insert_inc_spin.get_value_as_int()
-        start= self.insert_start_spin.get_value_as_int()
-        text = self.inject((index-1)*inc + start, text)
-        from_index = self.insert_spin.get_value_as_int() - 1
-        a = len(string)
-        b = len(text)
-        if self.insert_reverse_check.get_active():
-            diff = max(0, a - from_index)
-            if self.overwrite_check.get_active():
-                return string[0:diff] + text + string[diff + b:]
+            tracing.count("preview_cache_hits")
+
+        if len(exif_unread) > 0:
+            self.read_exif_dates(exif_unread)
+
+        if len(existing) > 0:
+            file_obj, new_name = existing[0]
+            others = len(existing) - 1
+            path = os.path.join(file_obj.get_parent_path_or_uri_for_display(), new_name)
+            self.infobar.show()
+            if others == 0:
+                self.error_label.set_text(_("'%s' already exists.") % path)
             else:
-                return string[0:diff] + text + string[diff:]
-        else:
-            if self.overwrite_check.get_active():
-                return string[0:from_index] + text + string[from_index + b:]
+                self.error_label.set_text(gettext.ngettext("'%s' already exists, as does %d other new name.",
+                                                           "'%s' already exists, as do %d other new names.",
+                                                           others) \
+                    % (path, others))
+            any_errors = True
+
+        # Every row sharing a target with another row is in collision
+        collisions = []
+        for iters in self.pending_uris.values():
+            if len(iters) > 1:
+                collisions.extend(iters)
+        if len(collisions) > 0:
+            for iter in collisions:
+                self.collision_uris.add(self.model.get_value(iter, COL_FILE).uri)
+            file_obj = self.model.get_value(collisions[0], COL_FILE)
+            others = len(collisions) - 1
+            self.infobar.show()
+            self.error_label.set_text(gettext.ngettext("Name collision on '%s' and %d other file.",
+                                                       "Name collision on '%s' and %d other files.",
+                                                       others) \
+                % (file_obj.get_path_or_uri_for_display(), others))
+            any_errors = True
+        self.treeview.queue_draw()
+
+        # Wait for the listings and EXIF dates before allowing a rename, the
+        # preview runs again once they're in.
+        reading = use_exif and len(self.exif_reading) > 0
+        self.rename_button.set_sensitive(any_changes and not any_errors and not listing and not reading)
+
+    def on_pool_preview_done(self, request, result, error):
+        if request is self.preview_pool_request:
+            self.preview_pool_request = None
+            self.preview_pool_result = (result, error)
+            self.preview_source_id = GLib.idle_add(self.run_preview_chunk)
+        return GLib.SOURCE_REMOVE
+
+    def read_exif_dates(self, file_objs):
+        # Read the dates in worker threads, in chunks, once per file
+        import concurrent.futures
+        import metadata
+        if self.metadata_executor is None:
+            self.metadata_executor = concurrent.futures.ThreadPoolExecutor(max_workers=METADATA_WORKERS)
+        local_objs = []
+        paths = []
+        for file_obj in file_objs:
+            path = file_obj.gfile.get_path()
+            if path is None or file_obj.is_dir:
+                file_obj.exif_read = True
             else:
-                return string[0:from_index] + text + string[from_index:]
-
-    def change_case(self, index, string):
-        if self.radio_titlecase.get_active():
-            return string.title()
-        elif self.radio_lowercase.get_active():
-            return string.lower()
-        elif self.radio_uppercase.get_active():
-            return string.upper()
-        elif self.radio_firstuppercase.get_active():
-            return string.capitalize()
+                local_objs.append(file_obj)
+                paths.append(path)
+        for i in range(0, len(paths), METADATA_CHUNK_SIZE):
+            chunk = local_objs[i:i + METADATA_CHUNK_SIZE]
+            self.exif_reading.update(chunk)
+            future = self.metadata_executor.submit(metadata.read_exif_dates, paths[i:i + METADATA_CHUNK_SIZE])
+            # Done callbacks run in the worker thread, get back to the main loop
+            future.add_done_callback(lambda future, chunk=chunk: GLib.idle_add(self.on_exif_dates_read, chunk, future))
+
+    def get_preview_pool(self):
+        if self.preview_pool is None:
+            import parallel
+            self.preview_pool = parallel.PreviewPool()
+        return self.preview_pool
+
+    def on_exif_dates_read(self, chunk, future):
+        try:
+            dates = future.result()
+        except Exception as e:
+            print(e)
+            dates = [None] * len(chunk)
+        for file_obj, date in zip(chunk, dates):
+            file_obj.exif_date = date
+            file_obj.exif_read = True
+            self.exif_reading.discard(file_obj)
+        tracing.count("exif_dates_read", len(chunk))
+        self.rows_changed()
+        if len(self.exif_reading) == 0:
+            self.preview_changes(debounce=True)
+        return GLib.SOURCE_REMOVE
+
+    def get_rename_plan(self):
+        # The plan is only rebuilt when the operation settings change
+        if self.plan is None:
+            self.plan = engine.RenamePlan(self.get_rename_params())
+        return self.plan
+
+    def get_rename_params(self):
+        # The previous steps, if any, then the current operation. They're
+        # all applied in a single pass and each file is renamed once.
+        params = self.get_step_params()
+        if len(self.steps) > 0:
+            return engine.RenamePipeline([step for label, step in self.steps] + [params])
+        return params
+
+    def get_step_params(self):
+        # Snapshot the widgets into a parameter object for the engine
+        if self.operation == "replace":
+            operation = engine.ReplaceOperation(find=self.find_entry.get_text(),
+                                                replace=self.replace_entry.get_text(),
+                                                regex=self.replace_regex_check.get_active(),
+                                                case=self.replace_case_check.get_active(),
+                                                start=self.replace_start_spin.get_value_as_int(),
+                                                inc=self.replace_inc_spin.get_value_as_int())
+        elif self.operation == "remove":
+            operation = engine.RemoveOperation(from_index=self.remove_from_spin.get_value_as_int(),
+                                               from_reverse=self.remove_from_check.get_active(),
+                                               to_index=self.remove_to_spin.get_value_as_int(),
+                                               to_reverse=self.remove_to_check.get_active())
+        elif self.operation == "insert":
+            operation = engine.InsertOperation(text=self.insert_entry.get_text(),
+                                               position=self.insert_spin.get_value_as_int(),
+                                               reverse=self.insert_reverse_check.get_active(),
+                                               overwrite=self.overwrite_check.get_active(),
+                                               start=self.insert_start_spin.get_value_as_int(),
+                                               inc=self.insert_inc_spin.get_value_as_int())
         else:
-            return unidecode.unidecode(string)
+            if self.radio_titlecase.get_active():
+                mode = engine.CASE_TITLE
+            elif self.radio_lowercase.get_active():
+                mode = engine.CASE_LOWER
+            elif self.radio_uppercase.get_active():
+                mode = engine.CASE_UPPER
+            elif self.radio_firstuppercase.get_active():
+                mode = engine.CASE_FIRST_UPPER
+            else:
+                mode = engine.CASE_ACCENTS
+            operation = engine.CaseOperation(mode)
 
-    def inject(self, index, string):
-        def repl(match):
-            zeros = match.group(1)
-            width = len(zeros) + 1
-            return f"{index:0{width}d}"
-        return re.sub(r'%([0]*)n', repl, string)
+        return engine.RenameParams(operation, self.scope)
 
 '''
 TODO
@@ -814,6 +1893,25 @@ TODO
 
 '''
 
+def main():
+    setproctitle.setproctitle("bulky")
+
+    # --trace FILE (or BULKY_TRACE=FILE) records a trace of the session
+    tracing.enable_from_environment()
+    if "--trace" in sys.argv[1:-1]:
+        position = sys.argv.index("--trace")
+        tracing.enable(sys.argv[position + 1])
+        del sys.argv[position:position + 2]
+
+    # --service keeps the instance running in the background to serve later launches
+    service = "--service" in sys.argv[1:]
+    if service:
+        sys.argv.remove("--service")
+
+    application = MyApplication("org.x.bulky",
+                                Gio.ApplicationFlags.HANDLES_OPEN | Gio.ApplicationFlags.HANDLES_COMMAND_LINE,
+                                service)
+    application.run(sys.argv)
+
 if __name__ == "__main__":
-    application = MyApplication("org.x.bulky", Gio.ApplicationFlags.FLAGS_NONE)
-    application.run()
+    main()
@@ -0,0 +1,341 @@
+# Headless rename engine.
+#
+# Everything in here is plain Python: no gi, no widgets. The main window
+# builds an operation from its widgets and feeds it the loaded names, but
+# the same operations can be driven from scripts without a display.
+import datetime
+import os
+import re
+
+SCOPE_NAME_ONLY = "name"
+SCOPE_EXTENSION_ONLY = "extension"
+SCOPE_ALL = "all"
+
+CASE_TITLE = "title"
+CASE_LOWER = "lower"
+CASE_UPPER = "upper"
+CASE_FIRST_UPPER = "first-upper"
+CASE_ACCENTS = "accents"
+
+FIELD_MTIME = "mtime"
+FIELD_SIZE = "size"
+FIELD_EXIF = "exif"
+
+# Date format used by %mtime and %exif when none is given
+DEFAULT_DATE_FORMAT = "%Y-%m-%d"
+
+# The metadata of one file, for the templates using it. Any field can be
+# None when it's unknown.
+class FileMetadata():
+    __slots__ = ("mtime", "size", "exif_date")
+
+    def __init__(self, mtime=None, size=None, exif_date=None):
+        self.mtime = mtime # seconds since the epoch
+        self.size = size # bytes
+        self.exif_date = exif_date # datetime the photo was taken
+
+def identity(index, string, metadata=None):
+    return string
+
+# %n, %0n, %00n... the counter, padded with zeros
+# %mtime and %mtime{format} the modification date, strftime format
+# %exif and %exif{format} the date the photo was taken, or else the modification date
+# %size the size in bytes
+TEMPLATE_FIELDS = re.compile(r'%(?:(0*)n|(mtime|exif)(?:\{([^}]*)\})?|(size))')
+
+# A template split once into literal text and fields
+class Template():
+    def __init__(self, template):
+        self.template = template
+        self.parts = [] # literal text, then (field, argument) pairs
+        self.fields = set() # the metadata fields used
+        position = 0
+        for match in TEMPLATE_FIELDS.finditer(template):
+            self.parts.append(template[position:match.start()])
+            zeros, date_field, date_format, size_field = match.groups()
+            if zeros is not None:
+                self.parts.append(("n", len(zeros) + 1))
+            elif date_field is not None:
+                self.parts.append((date_field, date_format or DEFAULT_DATE_FORMAT))
+                self.fields.add(date_field)
+            else:
+                self.parts.append((FIELD_SIZE, None))
+                self.fields.add(FIELD_SIZE)
+            position = match.end()
+        self.parts.append(template[position:])
+        self.constant = len(self.parts) == 1
+
+    def expand(self, index, metadata=None):
+        if self.constant:
+            return self.template
+        parts = self.parts
+        out = [parts[0]]
+        for i in range(1, len(parts), 2):
+            field, argument = parts[i]
+            if field == "n":
+                out.append(f"{index:0{argument}d}")
+            else:
+                out.append(expand_field(field, argument, metadata))
+            out.append(parts[i + 1])
+        return "".join(out)
+
+def expand_field(field, argument, metadata):
+    # Unknown values expand to nothing
+    if metadata is None:
+        return ""
+    if field == FIELD_SIZE:
+        return "" if metadata.size is None else str(metadata.size)
+    date = None
+    if field == FIELD_EXIF:
+        date = metadata.exif_date
+    if date is None and metadata.mtime is not None:
+        date = datetime.datetime.fromtimestamp(metadata.mtime)
+    if date is None:
+        return ""
+    # Dates are part of a file name, no slashes
+    return date.strftime(argument).replace("/", "-")
+
+def wildcard_to_regex(find):
+    # Translate a search string with ? and * wildcards into a regex
+    find = find.replace("*", "~~~REGSTAR~~~")
+    find = find.replace("?", "~~~REGQUES~~~")
+    find = re.escape(find)
+    find = find.replace(re.escape("~~~REGSTAR~~~"), ".+")
+    find = find.replace(re.escape("~~~REGQUES~~~"), ".")
+    return find
+
+class ReplaceOperation():
+    def __init__(self, find="", replace="", regex=False, case=True, start=1, inc=1):
+        self.find = find
+        self.replace = replace
+        self.regex = regex
+        self.case = case
+        self.start = start
+        self.inc = inc
+
+    def key(self):
+        # Hashable, equal for operations giving the same results
+        return ("replace", self.find, self.replace, self.regex, self.case, self.start, self.inc)
+
+    def get_fields(self):
+        # The metadata fields the operation needs
+        if not self.find:
+            return set()
+        return Template(self.replace).fields
+
+    def compile(self):
+        if not self.find:  #ignore empty search string
+            return identity
+        find = self.find if self.regex else wildcard_to_regex(self.find)
+        try:
+            if self.case:
+                reg = re.compile(find)
+            else:
+                reg = re.compile(find, re.IGNORECASE)
+        except re.error:
+            return identity
+        template = Template(self.replace)
+        start = self.start
+        inc = self.inc
+
+        def function(index, string, metadata=None):
+            try:
+                return reg.sub(template.expand((index-1)*inc + start, metadata), string)
+            except re.error:
+                # e.g. an invalid group reference in the replacement
+                return string
+        return function
+
+class RemoveOperation():
+    def __init__(self, from_index=1, from_reverse=False, to_index=1, to_reverse=False):
+        self.from_index = from_index
+        self.from_reverse = from_reverse
+        self.to_index = to_index
+        self.to_reverse = to_reverse
+
+    def key(self):
+        return ("remove", self.from_index, self.from_reverse, self.to_index, self.to_reverse)
+
+    def get_fields(self):
+        return set()
+
+    def compile(self):
+        from_offset = self.from_index - 1
+        from_reverse = self.from_reverse
+        to_offset = self.to_index - 1
+        to_reverse = self.to_reverse
+
+        def function(index, string, metadata=None):
+            length = len(string)
+
+            if from_reverse:
+                from_index = max(length - from_offset, 0)
+            else:
+                from_index = min(length, from_offset)
+
+            if to_reverse:
+                to_index = max(length - to_offset, 0)
+            else:
+                to_index = min(length, to_offset)
+
+            return string[0:min(from_index, to_index)] + string[max(from_index, to_index):]
+        return function
+
+class InsertOperation():
+    def __init__(self, text="", position=1, reverse=False, overwrite=False, start=1, inc=1):
+        self.text = text
+        self.position = position
+        self.reverse = reverse
+        self.overwrite = overwrite
+        self.start = start
+        self.inc = inc
+
+    def key(self):
+        return ("insert", self.text, self.position, self.reverse, self.overwrite, self.start, self.inc)
+
+    def get_fields(self):
+        return Template(self.text).fields
+
+    def compile(self):
+        template = Template(self.text)
+        from_index = self.position - 1
+        reverse = self.reverse
+        overwrite = self.overwrite
+        start = self.start
+        inc = self.inc
+
+        def function(index, string, metadata=None):
+            text = template.expand((index-1)*inc + start, metadata)
+            a = len(string)
+            b = len(text)
+            if reverse:
+                diff = max(0, a - from_index)
+                if overwrite:
+                    return string[0:diff] + text + string[diff + b:]
+                else:
+                    return string[0:diff] + text + string[diff:]
+            else:
+                if overwrite:
+                    return string[0:from_index] + text + string[from_index + b:]
+                else:
+                    return string[0:from_index] + text + string[from_index:]
+        return function
+
+class CaseOperation():
+    def __init__(self, mode=CASE_TITLE):
+        self.mode = mode
+
+    def key(self):
+        return ("case", self.mode)
+
+    def get_fields(self):
+        return set()
+
+    def compile(self):
+        if self.mode == CASE_TITLE:
+            method = str.title
+        elif self.mode == CASE_LOWER:
+            method = str.lower
+        elif self.mode == CASE_UPPER:
+            method = str.upper
+        elif self.mode == CASE_FIRST_UPPER:
+            method = str.capitalize
+        else:
+            # Only imported when needed, it's slow to load
+            import unidecode
+            method = unidecode.unidecode
+        return lambda index, string, metadata=None: method(string)
+
+# The parameter object: one operation applied within one scope
+class RenameParams():
+    def __init__(self, operation, scope=SCOPE_NAME_ONLY):
+        self.operation = operation
+        self.scope = scope
+
+    def get_steps(self):
+        return [self]
+
+    def key(self):
+        return ((self.scope, self.operation.key()),)
+
+# Several operations applied one after the other, each within its own scope
+class RenamePipeline():
+    def __init__(self, steps):
+        self.steps = steps # RenameParams
+
+    def get_steps(self):
+        return self.steps
+
+    def key(self):
+        return tuple((step.scope, step.operation.key()) for step in self.steps)
+
+# Regular expressions can take any time to run, and stripping accents is
+# slow on large batches
+def uses_regex(params):
+    for step in params.get_steps():
+        operation = step.operation
+        if isinstance(operation, ReplaceOperation) and operation.regex and operation.find:
+            return True
+    return False
+
+def is_expensive(params):
+    if uses_regex(params):
+        return True
+    for step in params.get_steps():
+        operation = step.operation
+        if isinstance(operation, CaseOperation) and operation.mode == CASE_ACCENTS:
+            return True
+    return False
+
+def split_name(orig_name):
+    name, ext = os.path.splitext(orig_name)
+    if ext and ext.startswith('.'):
+        ext = ext[1:]
+    return name, ext
+
+def apply_in_scope(scope, function, index, orig_name, metadata):
+    if scope == SCOPE_ALL:
+        return function(index, orig_name, metadata)
+
+    name, ext = split_name(orig_name)
+    if scope == SCOPE_NAME_ONLY:
+        name = function(index, name, metadata)
+    elif scope == SCOPE_EXTENSION_ONLY:
+        ext = function(index, ext, metadata)
+    return name + ('.' if ext else '') + ext
+
+# A RenamePlan is built once per settings change and then applied to every
+# row: patterns are compiled and templates split up front. The steps of a
+# pipeline are all applied to a name in a single pass.
+class RenamePlan():
+    def __init__(self, params):
+        self.params = params
+        self.steps = [] # (scope, function)
+        self.fields = set()
+        for step in params.get_steps():
+            self.steps.append((step.scope, step.operation.compile()))
+            self.fields |= step.operation.get_fields()
+
+    def apply(self, index, orig_name, metadata=None):
+        # Return the new name for orig_name, index is 1-based
+        name = orig_name
+        for scope, function in self.steps:
+            name = apply_in_scope(scope, function, index, name, metadata)
+        return name
+
+    def rename(self, names, start_index=1, metadata=None):
+        # Yield the new name for each name in the (possibly lazy) iterable,
+        # metadata is an optional iterable of FileMetadata in the same order
+        index = start_index
+        apply = self.apply
+        if metadata is None:
+            for orig_name in names:
+                yield apply(index, orig_name)
+                index += 1
+        else:
+            for orig_name, file_metadata in zip(names, metadata):
+                yield apply(index, orig_name, file_metadata)
+                index += 1
+
+def rename(params, names, start_index=1, metadata=None):
+    return RenamePlan(params).rename(names, start_index, metadata)
@@ -0,0 +1,212 @@
+# Crash-safe rename journal.
+#
+# The journal holds the last rename batch, one JSON object per line:
+#
+#   {"batch": id, "undo": false}       header
+#   {"old": uri, "new": uri, "wave": n} one line per planned rename step
+#   {"begin": true}                     the plan is complete (synced)
+#   {"done": i} / {"failed": i}         outcome of step i
+#   {"undone": i}                       step i was reverted, its chain failed
+#   {"end": true, "cancelled": false}   the batch finished (synced)
+#
+# Outcomes are group-committed: they're only fsync'ed every
+# JOURNAL_SYNC_ENTRIES steps. At the end of each wave they're handed to the
+# kernel, without waiting for the disk, which is enough for them to survive
+# us crashing or being killed. Steps of a wave never depend on each other,
+# so after a crash only the steps of the wave that was running can be
+# missing an outcome, and for those we can look at the filesystem to tell
+# whether they happened. If the system itself goes down, the outcomes
+# written since the last sync can be lost like the renames themselves.
+import json
+import os
+import time
+
+JOURNAL_SYNC_ENTRIES = 1000
+# Bytes read from the end of the journal to check that the last batch ended
+JOURNAL_TAIL_BYTES = 4096
+
+class JournalBatch():
+    def __init__(self, batch_id, undo):
+        self.batch_id = batch_id
+        self.undo = undo # this batch undid another one
+        self.steps = [] # (old_uri, new_uri, wave)
+        self.begun = False
+        self.ended = False
+        self.cancelled = False
+        self.done = set()
+        self.failed = set()
+
+    def is_interrupted(self):
+        return self.begun and not self.ended
+
+    def can_undo(self):
+        return self.ended and not self.undo and len(self.done) > 0
+
+    def recover(self, exists):
+        # Return the indices of the steps which were carried out, checking
+        # the unrecorded steps of the interrupted wave with exists(uri).
+        done = set(self.done)
+        wave = None
+        for index, (old_uri, new_uri, step_wave) in enumerate(self.steps):
+            if index in self.done or index in self.failed:
+                continue
+            if wave is None:
+                wave = step_wave
+            elif step_wave != wave:
+                # Later waves never started
+                break
+            if exists(new_uri) and not exists(old_uri):
+                done.add(index)
+        return done
+
+    def get_undo_waves(self, done):
+        # Reverse every step that was carried out, last wave first
+        waves = []
+        wave = None
+        for index in reversed(range(len(self.steps))):
+            if index not in done:
+                continue
+            old_uri, new_uri, step_wave = self.steps[index]
+            if step_wave != wave or len(waves) == 0:
+                waves.append([])
+                wave = step_wave
+            waves[-1].append((new_uri, old_uri))
+        return waves
+
+    def get_remaining_waves(self, done):
+        # The steps that weren't carried out (nor failed), in order
+        waves = []
+        wave = None
+        for index, (old_uri, new_uri, step_wave) in enumerate(self.steps):
+            if index in done or index in self.failed:
+                continue
+            if step_wave != wave or len(waves) == 0:
+                waves.append([])
+                wave = step_wave
+            waves[-1].append((old_uri, new_uri))
+        return waves
+
+class RenameJournal():
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.unsynced = 0
+
+    def begin(self, waves, undo=False):
+        # waves: lists of (old_uri, new_uri). Replaces the previous batch.
+        # Returns the step index of each rename, in the same order.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.close()
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.write({"batch": "%x" % time.time_ns(), "undo": undo})
+        indices = []
+        index = 0
+        for wave_index, wave in enumerate(waves):
+            wave_indices = []
+            for old_uri, new_uri in wave:
+                self.write({"old": old_uri, "new": new_uri, "wave": wave_index})
+                wave_indices.append(index)
+                index += 1
+            indices.append(wave_indices)
+        self.write({"begin": True})
+        self.sync()
+        return indices
+
+    def mark_done(self, index):
+        self.write({"done": index})
+        self.count_entry()
+
+    def mark_failed(self, index):
+        self.write({"failed": index})
+        self.count_entry()
+
+    def mark_undone(self, index):
+        self.write({"undone": index})
+        self.count_entry()
+
+    def count_entry(self):
+        self.unsynced += 1
+        if self.unsynced >= JOURNAL_SYNC_ENTRIES:
+            self.sync()
+
+    def end_wave(self):
+        # One wave per rename for a shift chain, an fsync each would be slow
+        if self.file is not None:
+            self.file.flush()
+
+    def end(self, cancelled=False):
+        if self.file is None:
+            return
+        self.write({"end": True, "cancelled": cancelled})
+        self.sync()
+        self.close()
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def sync(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def may_be_interrupted(self):
+        # Cheap enough for every launch, only the end of the journal is
+        # read: False if the last batch ended. load() tells for sure.
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - JOURNAL_TAIL_BYTES))
+                tail = f.read()
+        except OSError:
+            return False
+        try:
+            entry = json.loads(tail.rstrip(b"\n").rsplit(b"\n", 1)[-1])
+        except ValueError:
+            return True
+        return "end" not in entry
+
+    def load(self):
+        # Return the last batch, or None
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return None
+
+        batch = None
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn write at the time of a crash
+                continue
+            if "batch" in entry:
+                batch = JournalBatch(entry["batch"], entry.get("undo", False))
+            elif batch is None:
+                continue
+            elif "old" in entry:
+                batch.steps.append((entry["old"], entry["new"], entry["wave"]))
+            elif "begin" in entry:
+                batch.begun = True
+            elif "done" in entry:
+                batch.done.add(entry["done"])
+            elif "failed" in entry:
+                batch.failed.add(entry["failed"])
+            elif "undone" in entry:
+                batch.done.discard(entry["undone"])
+                batch.failed.add(entry["undone"])
+            elif "end" in entry:
+                batch.ended = True
+                batch.cancelled = entry.get("cancelled", False)
+
+        if batch is None or not batch.begun:
+            # Nothing was renamed before the plan was fully written
+            return None
+        return batch
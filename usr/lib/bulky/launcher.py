@@ -0,0 +1,9 @@
+#!/usr/bin/python3
+# Starts bulky, see bulky.main().
+#
+# Keep this script small: the preview workers (parallel.py) are started
+# with "spawn", which runs the main script again in each of them. Starting
+# from bulky.py would load GTK in every worker for nothing.
+if __name__ == "__main__":
+    import bulky
+    bulky.main()
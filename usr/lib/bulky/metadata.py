@@ -0,0 +1,133 @@
+# Reads the date photos were taken from their EXIF data.
+#
+# Plain Python, only the headers are read: JPEG files (EXIF in the APP1
+# segment) and TIFF based files, which covers most camera raw formats
+# (DNG, CR2, NEF, ARW...). This runs in worker threads, see
+# read_exif_dates().
+import datetime
+import struct
+
+TAG_DATE_TIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_DATE_TIME_DIGITIZED = 0x9004
+
+TYPE_ASCII = 2
+
+# JPEG segments without a length
+JPEG_STANDALONE_MARKERS = set([0x01] + list(range(0xd0, 0xd8)))
+
+class ExifError(Exception):
+    pass
+
+def read_exif_dates(paths):
+    # Return the date taken of each file (or None), in the same order
+    dates = []
+    for path in paths:
+        try:
+            dates.append(read_exif_date(path))
+        except (OSError, ExifError, struct.error, ValueError):
+            dates.append(None)
+    return dates
+
+def read_exif_date(path):
+    with open(path, "rb") as f:
+        header = f.read(4)
+        if header[:2] == b"\xff\xd8":
+            offset = find_jpeg_exif(f)
+            if offset is None:
+                return None
+        elif header in (b"II*\0", b"MM\0*"):
+            offset = 0
+        else:
+            return None
+        return read_tiff_date(f, offset)
+
+def find_jpeg_exif(f):
+    # Return the offset of the TIFF header in the APP1 segment, or None
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] == 0xff:
+            # Padding
+            f.seek(-1, 1)
+            continue
+        if marker[1] in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker[1] in (0xd9, 0xda):
+            # End of image or start of the image data, no EXIF
+            return None
+        length = struct.unpack(">H", read_exactly(f, 2))[0]
+        if marker[1] == 0xe1 and length >= 8:
+            if read_exactly(f, 6) == b"Exif\0\0":
+                return f.tell()
+            f.seek(length - 8, 1)
+        else:
+            f.seek(length - 2, 1)
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise ExifError("truncated file")
+    return data
+
+def read_tiff_date(f, base):
+    # Offsets in the TIFF structure are relative to its header, at base
+    f.seek(base)
+    header = read_exactly(f, 8)
+    if header[:2] == b"II":
+        order = "<"
+    elif header[:2] == b"MM":
+        order = ">"
+    else:
+        raise ExifError("invalid TIFF header")
+    ifd_offset = struct.unpack(order + "I", header[4:])[0]
+
+    ifd0 = read_ifd(f, base, ifd_offset, order)
+    exif_ifd = {}
+    if TAG_EXIF_IFD in ifd0:
+        kind, count, value = ifd0[TAG_EXIF_IFD]
+        exif_offset = struct.unpack(order + "I", value)[0]
+        exif_ifd = read_ifd(f, base, exif_offset, order)
+
+    for ifd, tag in ((exif_ifd, TAG_DATE_TIME_ORIGINAL),
+                     (exif_ifd, TAG_DATE_TIME_DIGITIZED),
+                     (ifd0, TAG_DATE_TIME)):
+        if tag in ifd:
+            date = parse_date(read_ascii(f, base, ifd[tag], order))
+            if date is not None:
+                return date
+    return None
+
+def read_ifd(f, base, offset, order):
+    # Return {tag: (type, count, raw 4 byte value)}
+    f.seek(base + offset)
+    count = struct.unpack(order + "H", read_exactly(f, 2))[0]
+    entries = {}
+    data = read_exactly(f, count * 12)
+    for i in range(count):
+        tag, kind, value_count = struct.unpack(order + "HHI", data[i * 12:i * 12 + 8])
+        entries[tag] = (kind, value_count, data[i * 12 + 8:i * 12 + 12])
+    return entries
+
+def read_ascii(f, base, entry, order):
+    kind, count, value = entry
+    if kind != TYPE_ASCII:
+        return None
+    if count <= 4:
+        data = value[:count]
+    else:
+        f.seek(base + struct.unpack(order + "I", value)[0])
+        data = read_exactly(f, count)
+    return data.split(b"\0", 1)[0].decode("ascii", "replace")
+
+def parse_date(text):
+    # "YYYY:MM:DD HH:MM:SS", unset dates are often all zeros or spaces
+    if not text:
+        return None
+    try:
+        return datetime.datetime.strptime(text.strip(), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
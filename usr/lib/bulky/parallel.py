@@ -0,0 +1,167 @@
+# Multi-core preview, for large batches with expensive operations
+# (transliteration, regular expressions).
+#
+# The names are split into chunks, renamed by a pool of worker processes
+# and merged back in order. Only plain data crosses the process boundary:
+# the parameters (compiled plans hold closures, which can't be pickled),
+# the names and their metadata. Each chunk carries the index of its first
+# name so the %n numbering is the same as in a single pass.
+#
+# Workers are started with "spawn", forking a process running GTK isn't safe.
+# Spawned workers run the main script again before they start, which is
+# why bulky is started from the small launcher.py rather than bulky.py.
+#
+# Regular expressions always run in the workers, whatever the size of the
+# batch: a pattern with catastrophic backtracking can run for hours. A
+# batch has a time budget, counted from the moment a worker picks up its
+# first chunk (the monotonic clock is shared by all processes).
+#
+# Each batch also gets a generation number, so the workers can drop a batch
+# which was replaced or cancelled and the next preview doesn't wait behind
+# it. Chunks are skipped when a worker gets to them, and the chunks running
+# are stopped by an alarm, which checks the generation and the time left
+# every WORKER_CHECK_INTERVAL. The regex engine checks for signals while
+# matching. The main loop can't do any of that.
+import multiprocessing
+import os
+import signal
+import time
+
+import engine
+
+# Batches smaller than this are previewed in the main process
+PARALLEL_MIN_NAMES = 20000
+# Number of names per chunk sent to a worker
+PARALLEL_CHUNK_SIZE = 5000
+# Seconds between checks that a running chunk is still wanted
+WORKER_CHECK_INTERVAL = 0.1
+
+# The plan last compiled in this worker, as (key, plan)
+_plan = None
+# Shared with the pool: the current generation, and when a worker picked up
+# the first chunk of its batch (0 until then)
+_generation = None
+_started = None
+# (generation, deadline or None) of the chunk running in this worker
+_running = None
+
+class RegexTimeout(Exception):
+    pass
+
+class BatchCancelled(Exception):
+    pass
+
+def set_alarm():
+    generation, deadline = _running
+    delay = WORKER_CHECK_INTERVAL
+    if deadline is not None:
+        delay = min(delay, deadline - time.monotonic())
+    signal.setitimer(signal.ITIMER_REAL, max(delay, 0.001))
+
+def on_alarm(signum, frame):
+    if _running is None:
+        # The chunk just finished
+        return
+    generation, deadline = _running
+    if generation != _generation.value:
+        raise BatchCancelled()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise RegexTimeout("the regular expression ran out of time")
+    set_alarm()
+
+def init_worker(generation, started):
+    global _generation, _started
+    _generation = generation
+    _started = started
+
+def rename_chunk(params, start_index, names, metadata, generation, budget):
+    # Runs in the workers, budget is in seconds (or None).
+    # Returns None if the batch was replaced or cancelled.
+    global _plan, _running
+    with _generation.get_lock():
+        if generation != _generation.value:
+            return None
+        if _started.value == 0:
+            _started.value = time.monotonic()
+        started = _started.value
+    key = params.key()
+    if _plan is None or _plan[0] != key:
+        _plan = (key, engine.RenamePlan(params))
+    deadline = None if budget is None else started + budget
+    if deadline is not None and time.monotonic() >= deadline:
+        raise RegexTimeout("the regular expression ran out of time")
+
+    _running = (generation, deadline)
+    signal.signal(signal.SIGALRM, on_alarm)
+    set_alarm()
+    try:
+        try:
+            return list(_plan[1].rename(names, start_index, metadata))
+        finally:
+            _running = None
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except BatchCancelled:
+        return None
+
+class PreviewPool():
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None # started on first use
+        self.generation = None
+        self.started = None
+
+    def should_use(self, params, count):
+        if engine.uses_regex(params):
+            return True
+        return self.processes > 1 and count >= PARALLEL_MIN_NAMES and engine.is_expensive(params)
+
+    def start(self):
+        # Workers take a moment to start, this lets callers get them ready
+        # early. They're kept until close(), so later previews don't wait.
+        if self.pool is None:
+            context = multiprocessing.get_context("spawn")
+            self.generation = context.Value("q", 0)
+            self.started = context.Value("d", 0)
+            self.pool = context.Pool(self.processes, init_worker, (self.generation, self.started))
+
+    def rename(self, params, names, metadata, callback, budget=None):
+        # callback is called from another thread, with the new names in
+        # order and None, or with None and the error: RegexTimeout if the
+        # batch didn't finish within budget seconds. Starting a batch
+        # cancels the previous one, callback gets None and None then.
+        self.start()
+        generation = self.cancel()
+
+        chunks = []
+        for start in range(0, len(names), PARALLEL_CHUNK_SIZE):
+            end = start + PARALLEL_CHUNK_SIZE
+            chunk_metadata = None if metadata is None else metadata[start:end]
+            chunks.append((params, start + 1, names[start:end], chunk_metadata, generation, budget))
+
+        def on_done(results):
+            if any(chunk is None for chunk in results):
+                callback(None, None)
+            else:
+                callback([name for chunk in results for name in chunk], None)
+
+        def on_error(error):
+            if not isinstance(error, RegexTimeout):
+                print("Parallel preview failed: %s" % error)
+            callback(None, error)
+
+        self.pool.starmap_async(rename_chunk, chunks, callback=on_done, error_callback=on_error)
+
+    def cancel(self):
+        # Skip the chunks not started yet, returns the new generation
+        if self.generation is None:
+            return 0
+        with self.generation.get_lock():
+            self.generation.value += 1
+            self.started.value = 0
+            return self.generation.value
+
+    def close(self):
+        # Kills the workers, even in the middle of a chunk
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,75 @@
+# Streaming reader for lists of paths or URIs, from stdin or a file.
+#
+# Entries are separated by newlines, or by NUL characters as output by
+# "find -print0". The stream is read in chunks with Gio's async API and
+# entries are handed over as soon as they're complete, so files start
+# loading before the whole list is read. The reader only reads the next
+# chunk when asked to, which lets the caller hold it back while it's busy.
+import os
+from gi.repository import Gio, GLib
+
+# Number of bytes requested per read
+LIST_READ_SIZE = 64 * 1024
+
+class PathListReader():
+    def __init__(self, stream, null_separated, cancellable, found_callback, done_callback):
+        self.stream = stream
+        self.separator = b"\0" if null_separated else b"\n"
+        self.cancellable = cancellable
+        self.found_callback = found_callback # called with a list of paths or URIs, after every chunk
+        self.done_callback = done_callback # called with the reader once finished
+        self.buffer = b"" # incomplete last entry
+        self.reading = False
+        self.finished = False
+        self.num_found = 0
+
+    def read(self):
+        # Read the next chunk, unless one is already being read
+        if self.reading or self.finished:
+            return
+        if self.cancellable.is_cancelled():
+            self.finish()
+            return
+        self.reading = True
+        self.stream.read_bytes_async(LIST_READ_SIZE, GLib.PRIORITY_LOW, self.cancellable,
+                                     self.on_read, None)
+
+    def on_read(self, stream, result, data):
+        self.reading = False
+        try:
+            data = stream.read_bytes_finish(result).get_data()
+        except GLib.Error as e:
+            if e.code != Gio.IOErrorEnum.CANCELLED:
+                print("Unable to read the file list: %s" % e.message)
+            self.finish()
+            return
+
+        if len(data) == 0:
+            # End of the list, the last entry may have no separator
+            self.finished = True
+            self.deliver([self.buffer])
+            self.buffer = b""
+            self.finish()
+            return
+
+        entries = (self.buffer + data).split(self.separator)
+        self.buffer = entries.pop()
+        self.deliver(entries)
+
+    def deliver(self, entries):
+        paths = []
+        for entry in entries:
+            if self.separator == b"\n":
+                entry = entry.rstrip(b"\r")
+            if len(entry) > 0:
+                paths.append(os.fsdecode(entry))
+        self.num_found += len(paths)
+        self.found_callback(paths)
+
+    def finish(self):
+        self.finished = True
+        try:
+            self.stream.close(None)
+        except GLib.Error:
+            pass
+        self.done_callback(self)
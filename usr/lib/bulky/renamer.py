@@ -0,0 +1,262 @@
+# Rename executor.
+#
+# Renames are grouped in waves: every rename in a wave is independent from
+# the others so they run concurrently (Gio does the work in its thread pool),
+# and a wave only starts once the previous one is complete. This is what
+# keeps children renamed before their parent directory.
+#
+# When given a journal, the whole plan is recorded before anything is
+# renamed and the outcome of each rename as it completes.
+#
+# A job can wait for the previous step of its chain (see scheduler). If
+# that step failed, the job is skipped rather than failing in turn. When the
+# step closing a cycle is skipped, the steps of the cycle which were carried
+# out are reverted, so no file is left under its temporary name.
+#
+# Local files take a faster path: each parent directory is opened once and
+# files are renamed relative to it with renameat2(RENAME_NOREPLACE), in a
+# thread pool. The kernel refuses to replace an existing file, so a file
+# created after the preview checked for collisions can't be overwritten.
+# Other files, or filesystems without RENAME_NOREPLACE, go through Gio.
+import collections
+import concurrent.futures
+import ctypes
+import errno
+import os
+from gi.repository import Gio, GLib
+
+import tracing
+
+# Number of renames kept in flight
+RENAME_MAX_PENDING = 16
+# Threads doing the local renames
+RENAME_THREADS = 4
+
+RENAME_NOREPLACE = 1
+
+def load_renameat2():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = libc.renameat2 # glibc 2.28
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    function.restype = ctypes.c_int
+    return function
+
+_renameat2 = load_renameat2()
+
+def rename_noreplace(dir_fd, old_name, new_name):
+    # Runs in the thread pool, names are bytes relative to dir_fd
+    if _renameat2(dir_fd, old_name, dir_fd, new_name, RENAME_NOREPLACE) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+class RenameJob():
+    def __init__(self, gfile, new_name, data=None):
+        self.gfile = gfile
+        self.new_name = new_name
+        self.data = data # opaque, for the caller
+        self.new_gfile = None
+        self.error = None
+        self.index = None # step index in the journal
+        self.trace = None
+        self.previous = None # job of the previous step in the chain
+        self.rollback = False # closes a cycle
+        self.undoes = None # the job this one reverts
+
+    def get_new_uri(self):
+        return self.gfile.get_parent().get_child(self.new_name).get_uri()
+
+def make_jobs(waves):
+    # Waves of scheduler.RenameStep to waves of RenameJob
+    jobs = {}
+    job_waves = []
+    for wave in waves:
+        job_wave = []
+        for step in wave:
+            new_name = Gio.File.new_for_uri(step.target).get_basename()
+            job = RenameJob(Gio.File.new_for_uri(step.source), new_name, step.data)
+            if step.previous is not None:
+                job.previous = jobs[step.previous]
+            job.rollback = step.rollback
+            jobs[step] = job
+            job_wave.append(job)
+        job_waves.append(job_wave)
+    return job_waves
+
+class RenameExecutor():
+    def __init__(self, waves, progress_callback, renamed_callback, done_callback, journal=None, undo=False):
+        self.waves = collections.deque(collections.deque(wave) for wave in waves if len(wave) > 0)
+        self.journal = journal
+        self.undo = undo # the batch reverts a previous one
+        self.total = sum(len(wave) for wave in self.waves)
+        self.done = 0
+        self.pending = 0
+        self.errors = [] # failed jobs, with their error set
+        self.cancellable = Gio.Cancellable()
+        self.native = _renameat2 is not None
+        self.thread_pool = None
+        self.dir_fds = {} # path -> fd of the parent directories
+        self.progress_callback = progress_callback # called with (done, total)
+        self.renamed_callback = renamed_callback # called with each successful job
+        self.done_callback = done_callback # called with the executor once finished
+
+    def start(self):
+        if self.journal is not None:
+            try:
+                indices = self.journal.begin([[(job.gfile.get_uri(), job.get_new_uri()) for job in wave]
+                                              for wave in self.waves], self.undo)
+                for wave, wave_indices in zip(self.waves, indices):
+                    for job, index in zip(wave, wave_indices):
+                        job.index = index
+            except OSError as e:
+                # Better to rename without a journal than not at all
+                print("Unable to write the rename journal: %s" % e)
+                self.journal = None
+        self.process_queue()
+
+    def cancel(self):
+        self.cancellable.cancel()
+
+    def is_cancelled(self):
+        return self.cancellable.is_cancelled()
+
+    def process_queue(self):
+        if self.cancellable.is_cancelled():
+            self.waves.clear()
+
+        while len(self.waves) > 0:
+            wave = self.waves[0]
+            while len(wave) > 0 and self.pending < RENAME_MAX_PENDING:
+                job = wave.popleft()
+                if job.previous is not None and job.previous.new_gfile is None:
+                    self.skip_job(job)
+                    continue
+                self.pending += 1
+                job.trace = tracing.begin("rename")
+                if not (self.native and job.gfile.is_native() and self.start_native_rename(job)):
+                    self.start_gio_rename(job)
+            if len(wave) > 0 or self.pending > 0:
+                # Move on to the next wave only once this one is complete
+                return
+            self.waves.popleft()
+            if self.journal is not None:
+                self.journal.end_wave()
+
+        if self.pending == 0:
+            self.close_native()
+            if self.journal is not None:
+                self.journal.end(self.is_cancelled())
+            self.done_callback(self)
+
+    def skip_job(self, job):
+        # The chain stopped at an earlier step, this one would fail
+        job.error = job.previous.error
+        if job.error is not None:
+            self.errors.append(job)
+        if self.journal is not None and job.index is not None:
+            self.journal.mark_failed(job.index)
+        self.done += 1
+        self.progress_callback(self.done, self.total)
+        if job.rollback:
+            self.roll_back(job)
+
+    def roll_back(self, job):
+        # Revert the steps of the cycle that were carried out, latest first.
+        # The file moved to the temporary name gets the data of the step
+        # which should have brought it to its new name.
+        jobs = []
+        step = job.previous
+        while step is not None:
+            if step.new_gfile is not None:
+                undo_job = RenameJob(step.new_gfile, step.gfile.get_basename(),
+                                     step.data if step.previous is not None else job.data)
+                undo_job.undoes = step
+                if len(jobs) > 0:
+                    undo_job.previous = jobs[-1]
+                jobs.append(undo_job)
+            step = step.previous
+        if len(jobs) == 0:
+            return
+        # One after the other, before the waves still to come
+        self.waves[0].append(jobs[0])
+        for index, undo_job in enumerate(jobs[1:]):
+            self.waves.insert(index + 1, collections.deque([undo_job]))
+        self.total += len(jobs)
+
+    def start_gio_rename(self, job):
+        job.gfile.set_display_name_async(job.new_name, GLib.PRIORITY_DEFAULT, self.cancellable,
+                                         self.on_renamed, job)
+
+    def start_native_rename(self, job):
+        # Returns False if the file can't take the fast path
+        path = job.gfile.get_path()
+        if path is None:
+            return False
+        directory, name = os.path.split(path)
+        dir_fd = self.dir_fds.get(directory)
+        if dir_fd is None:
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                return False
+            self.dir_fds[directory] = dir_fd
+        if self.thread_pool is None:
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=RENAME_THREADS)
+        future = self.thread_pool.submit(rename_noreplace, dir_fd, os.fsencode(name), os.fsencode(job.new_name))
+        # Done callbacks run in the worker thread, get back to the main loop
+        future.add_done_callback(lambda future: GLib.idle_add(self.on_native_renamed, job, future))
+        return True
+
+    def on_native_renamed(self, job, future):
+        error = future.exception()
+        if error is None:
+            # No need to query anything, we know the new name
+            job.new_gfile = job.gfile.get_parent().get_child(job.new_name)
+            self.finish_job(job, None)
+        elif error.errno in (errno.EINVAL, errno.ENOSYS):
+            # The filesystem doesn't support RENAME_NOREPLACE
+            self.start_gio_rename(job)
+        else:
+            self.finish_job(job, GLib.Error.new_literal(Gio.io_error_quark(), error.strerror,
+                                                        Gio.io_error_from_errno(error.errno)))
+        return GLib.SOURCE_REMOVE
+
+    def close_native(self):
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown(wait=False)
+            self.thread_pool = None
+        for dir_fd in self.dir_fds.values():
+            os.close(dir_fd)
+        self.dir_fds.clear()
+
+    def on_renamed(self, gfile, result, job):
+        try:
+            job.new_gfile = gfile.set_display_name_finish(result)
+            self.finish_job(job, None)
+        except GLib.Error as e:
+            self.finish_job(job, e)
+
+    def finish_job(self, job, error):
+        self.pending -= 1
+        if error is None:
+            tracing.end(job.trace)
+            tracing.count("renames")
+            if self.journal is not None:
+                if job.index is not None:
+                    self.journal.mark_done(job.index)
+                elif job.undoes is not None and job.undoes.index is not None:
+                    self.journal.mark_undone(job.undoes.index)
+            self.renamed_callback(job)
+        else:
+            tracing.end(job.trace, error=error.message)
+            if error.code != Gio.IOErrorEnum.CANCELLED:
+                tracing.count("rename_errors")
+                job.error = error
+                self.errors.append(job)
+                if self.journal is not None and job.index is not None:
+                    self.journal.mark_failed(job.index)
+        self.done += 1
+        self.progress_callback(self.done, self.total)
+        self.process_queue()
@@ -0,0 +1,131 @@
+# Recursive folder enumeration, used to add the contents of directory trees.
+#
+# Directories are enumerated with Gio's async API, several subtrees at a
+# time, reading children in large batches. Filters are applied while
+# enumerating so excluded subtrees are never walked.
+import collections
+import fnmatch
+from gi.repository import Gio, GLib
+
+# Number of children requested per next_files call
+SCAN_BATCH_SIZE = 1000
+# Number of directories enumerated concurrently
+SCAN_MAX_PENDING = 8
+
+def parse_patterns(text):
+    # "*.jpg, *.png" -> ["*.jpg", "*.png"]
+    patterns = []
+    for pattern in text.replace(";", ",").split(","):
+        pattern = pattern.strip()
+        if pattern:
+            patterns.append(pattern)
+    return patterns
+
+class ScanOptions():
+    def __init__(self, max_depth=0, include=None, exclude=None, hidden=False, folders=False):
+        self.max_depth = max_depth # 0 means unlimited
+        self.include = include or [] # patterns files must match (all files if empty)
+        self.exclude = exclude or [] # patterns excluding files and whole subtrees
+        self.hidden = hidden # also add hidden files and walk hidden folders
+        self.folders = folders # add the folders themselves, not just their files
+
+    def is_included(self, name):
+        if len(self.include) == 0:
+            return True
+        for pattern in self.include:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def is_excluded(self, name):
+        for pattern in self.exclude:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+class FolderScanner():
+    def __init__(self, attributes, options, cancellable, found_callback, done_callback):
+        # attributes must include standard::name, standard::type and standard::is-hidden
+        self.attributes = attributes
+        self.options = options
+        self.cancellable = cancellable
+        self.found_callback = found_callback # called with a list of (gfile, info)
+        self.done_callback = done_callback # called with the scanner once finished
+        self.queue = collections.deque()
+        self.pending = 0
+        self.num_found = 0
+
+    def scan(self, directory):
+        self.queue.append((directory, 1))
+        self.process_queue()
+
+    def process_queue(self):
+        if self.cancellable.is_cancelled():
+            self.queue.clear()
+        while self.pending < SCAN_MAX_PENDING and len(self.queue) > 0:
+            directory, depth = self.queue.popleft()
+            self.pending += 1
+            directory.enumerate_children_async(self.attributes, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS,
+                                               GLib.PRIORITY_LOW, self.cancellable,
+                                               self.on_enumerate_children, (directory, depth))
+        if self.pending == 0:
+            self.done_callback(self)
+
+    def on_enumerate_children(self, directory, result, data):
+        try:
+            enumerator = directory.enumerate_children_finish(result)
+        except GLib.Error as e:
+            if e.code != Gio.IOErrorEnum.CANCELLED:
+                print(e.message)
+            self.finish_directory()
+            return
+
+        enumerator.next_files_async(SCAN_BATCH_SIZE, GLib.PRIORITY_LOW, self.cancellable,
+                                    self.on_next_files, data)
+
+    def on_next_files(self, enumerator, result, data):
+        directory, depth = data
+        try:
+            infos = enumerator.next_files_finish(result)
+        except GLib.Error as e:
+            if e.code != Gio.IOErrorEnum.CANCELLED:
+                print(e.message)
+            infos = []
+
+        if len(infos) == 0:
+            try:
+                enumerator.close(None)
+            except GLib.Error:
+                pass
+            self.finish_directory()
+            return
+
+        options = self.options
+        found = []
+        for info in infos:
+            name = info.get_name()
+            if not options.hidden and (info.get_is_hidden() or name.startswith(".")):
+                continue
+            if options.is_excluded(name):
+                continue
+            child = directory.get_child(name)
+            if info.get_file_type() == Gio.FileType.DIRECTORY:
+                if options.max_depth == 0 or depth < options.max_depth:
+                    self.queue.append((child, depth + 1))
+                if options.folders and options.is_included(name):
+                    found.append((child, info))
+            elif options.is_included(name):
+                found.append((child, info))
+
+        if len(found) > 0:
+            self.num_found += len(found)
+            self.found_callback(found)
+
+        # Start on the subdirectories found so far while we read the next batch
+        self.process_queue()
+        enumerator.next_files_async(SCAN_BATCH_SIZE, GLib.PRIORITY_LOW, self.cancellable,
+                                    self.on_next_files, data)
+
+    def finish_directory(self):
+        self.pending -= 1
+        self.process_queue()
@@ -0,0 +1,120 @@
+# Rename scheduler.
+#
+# Turns a list of renames into waves of independent steps:
+#
+# - Within a directory, a rename whose target is the current name of
+#   another file or directory being renamed waits for it to move out of
+#   the way (b->c before a->b).
+# - A directory is only renamed once everything inside it was, so nothing
+#   is renamed after its parent.
+# - Cycles (a->b, b->a) are broken by moving one file of each cycle to a
+#   temporary name first, which is the minimum possible.
+#
+# Each step is linked to the one before it in its chain. If a step fails,
+# the rest of its chain can't run, and a cycle is put back the way it was
+# rather than leaving a file under its temporary name.
+#
+# Plain Python, URIs are handled as strings.
+import collections
+import uuid
+
+class RenameStep():
+    def __init__(self, source, target, data=None):
+        self.source = source # uri
+        self.target = target # uri, in the same directory
+        self.data = data # only set on the step bringing a file to its final name
+        self.previous = None # the step this one waits for, in its chain
+        self.rollback = False # closes a cycle, put the chain back if it can't run
+
+def make_temp_name():
+    return ".bulky-%s.tmp" % uuid.uuid4().hex[:16]
+
+def split_uri(uri):
+    parent, name = uri.rsplit("/", 1)
+    return parent, name
+
+def schedule(renames, temp_name=make_temp_name):
+    # renames: iterable of (source_uri, target_uri, is_dir, data)
+    # Returns a list of waves, each a list of RenameStep.
+    directories = collections.defaultdict(list)
+    dirs = set()
+    for source, target, is_dir, data in renames:
+        if source == target:
+            continue
+        if is_dir:
+            dirs.add(source.rstrip("/"))
+        parent, name = split_uri(source)
+        directories[parent].append((name, split_uri(target)[1], data))
+
+    # First wave in which a directory can be renamed: the one after the last
+    # rename inside it. Directories are handled from the deepest, so this is
+    # known by the time their parent is scheduled.
+    ready = {}
+    waves = []
+    for parent in sorted(directories.keys(), key=lambda parent: (-parent.count("/"), parent)):
+        end = 0
+        for chain in schedule_directory(parent, directories[parent], temp_name):
+            wave = -1
+            previous = None
+            for step in chain:
+                step.previous = previous
+                previous = step
+                wave = wave + 1
+                if step.source in dirs:
+                    wave = max(wave, ready.get(step.source, 0))
+                while len(waves) <= wave:
+                    waves.append([])
+                waves[wave].append(step)
+            end = max(end, wave + 1)
+        ancestor = parent
+        while "/" in ancestor:
+            if ready.get(ancestor, 0) < end:
+                ready[ancestor] = end
+            ancestor = split_uri(ancestor)[0]
+
+    for wave in waves:
+        wave.sort(key=lambda step: step.source)
+    return waves
+
+def schedule_directory(parent, renames, temp_name):
+    # renames: list of (name, new_name, data) inside one directory.
+    # Yields chains, lists of RenameStep to run one after the other.
+    # Separate chains don't depend on each other.
+    by_source = {}
+    by_target = {}
+    for rename in renames:
+        by_source[rename[0]] = rename
+        by_target[rename[1]] = rename
+
+    def uri(name):
+        return parent + "/" + name
+
+    scheduled = set()
+
+    def walk_back(rename):
+        # rename, then whoever wants its current name, and so on
+        chain = []
+        while rename is not None and rename[0] not in scheduled:
+            scheduled.add(rename[0])
+            chain.append(RenameStep(uri(rename[0]), uri(rename[1]), rename[2]))
+            rename = by_target.get(rename[0])
+        return chain
+
+    # Chains: start from the renames whose target is free
+    for rename in renames:
+        if rename[1] not in by_source:
+            yield walk_back(rename)
+
+    # Whatever is left is made of cycles
+    for rename in sorted(renames, key=lambda rename: rename[0]):
+        if rename[0] in scheduled:
+            continue
+        name, new_name, data = rename
+        temp = temp_name()
+        scheduled.add(name)
+        chain = [RenameStep(uri(name), uri(temp))]
+        chain.extend(walk_back(by_target[name]))
+        step = RenameStep(uri(temp), uri(new_name), data)
+        step.rollback = True
+        chain.append(step)
+        yield chain
@@ -0,0 +1,106 @@
+# Opt-in tracing of the load, preview and rename phases.
+#
+# Enabled with BULKY_TRACE=/path/to/trace.json or --trace /path/to/trace.json.
+# Spans and counters are recorded in memory and written on exit in the
+# Chrome trace event format (load it in chrome://tracing or Perfetto).
+#
+# When tracing is disabled every call returns straight away.
+import atexit
+import itertools
+import json
+import os
+import threading
+import time
+
+_events = None
+_path = None
+_counters = {}
+_ids = itertools.count(1)
+_pid = os.getpid()
+
+def enable(path):
+    global _events, _path
+    if _events is not None:
+        return
+    _events = []
+    _path = path
+    atexit.register(write)
+
+def enable_from_environment():
+    path = os.environ.get("BULKY_TRACE")
+    if path:
+        enable(path)
+
+def is_enabled():
+    return _events is not None
+
+def _now():
+    return time.perf_counter_ns() // 1000
+
+class _Span():
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        event = {"name": self.name, "ph": "X", "ts": self.start, "dur": _now() - self.start,
+                 "pid": _pid, "tid": threading.get_ident()}
+        if self.args:
+            event["args"] = self.args
+        _events.append(event)
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_no_span = _NoSpan()
+
+def span(name, **args):
+    # Synchronous span: with tracing.span("name"): ...
+    if _events is None:
+        return _no_span
+    return _Span(name, args)
+
+def begin(name, **args):
+    # Start an asynchronous span (e.g. from a Gio call to its callback).
+    # Returns a token for end(), None when tracing is disabled.
+    if _events is None:
+        return None
+    token = (name, next(_ids))
+    event = {"name": name, "cat": "async", "ph": "b", "id": token[1], "ts": _now(), "pid": _pid}
+    if args:
+        event["args"] = args
+    _events.append(event)
+    return token
+
+def end(token, **args):
+    if _events is None or token is None:
+        return
+    event = {"name": token[0], "cat": "async", "ph": "e", "id": token[1], "ts": _now(), "pid": _pid}
+    if args:
+        event["args"] = args
+    _events.append(event)
+
+def count(name, increment=1):
+    if _events is None:
+        return
+    value = _counters.get(name, 0) + increment
+    _counters[name] = value
+    _events.append({"name": name, "ph": "C", "ts": _now(), "pid": _pid, "args": {name: value}})
+
+def write():
+    if _events is None:
+        return
+    try:
+        with open(_path, "w") as f:
+            json.dump({"traceEvents": _events, "displayTimeUnit": "ms",
+                       "otherData": {"counters": _counters}}, f)
+    except OSError as e:
+        print("Unable to write the trace to %s: %s" % (_path, e))